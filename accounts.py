@@ -0,0 +1,135 @@
+import time
+import copy
+import atexit
+import threading
+
+from collections import OrderedDict
+
+MISSING = object() # cached "no account with this nick"
+
+
+class AccountStore:
+    """
+    Registered accounts, loaded lazily from `backend` into an LRU cache
+    Changes are marked dirty and written by a background thread every
+    `interval` seconds, so many changes to the same account between
+    flushes only cost one write
+    """
+    def __init__(self, backend, size=1000, interval=1):
+        self.backend = backend
+        self.size = size
+        self.interval = interval
+        self.cache = OrderedDict() # nick -> account, oldest first
+        self.dirty = set()
+        # Guards cache and dirty and the account dicts, hold it while
+        # changing an account you got from get()
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def get(self, nick):
+        """
+        Returns the account of `nick` or None
+        """
+        with self.lock:
+            account = self.cache.pop(nick, None)
+            if account is None:
+                account = self.backend.get_account(nick)
+                if account is None:
+                    account = MISSING
+            self.cache[nick] = account
+            self.trim()
+            if account is not MISSING:
+                return account
+
+    def get_by_uuid(self, uuid):
+        """
+        Returns the nick that owns the account `uuid` or None
+        Looks at the cache first, it can hold accounts not written yet
+        """
+        with self.lock:
+            for nick, account in self.cache.iteritems():
+                if account is not MISSING and account.get("uuid") == uuid:
+                    return nick
+        found = self.backend.get_account_by_uuid(uuid)
+        if found:
+            return found[0]
+
+    def create(self, nick, account):
+        """
+        Adds a new account
+        Returns False if `nick` already has one
+        """
+        with self.lock:
+            if self.get(nick):
+                return False
+            self.save(nick, account)
+            return True
+
+    def save(self, nick, account):
+        """
+        Marks the account of `nick` as changed
+        It is written on the next flush. The account goes back into the
+        cache, it may have been trimmed since the caller got it
+        """
+        with self.lock:
+            self.cache.pop(nick, None)
+            self.cache[nick] = account
+            self.dirty.add(nick)
+
+    def trim(self):
+        """
+        Drops the least recently used accounts when the cache is full
+        Accounts waiting to be written are kept until they are flushed
+        """
+        if len(self.cache) <= self.size:
+            return
+        for nick in list(self.cache):
+            if len(self.cache) <= self.size:
+                break
+            if nick not in self.dirty:
+                del self.cache[nick]
+
+    def flush(self):
+        """
+        Writes every changed account to the backend
+        """
+        with self.flush_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                pending = []
+                for nick in self.dirty:
+                    account = self.cache.get(nick)
+                    if account is None or account is MISSING:
+                        print("Not saving account %s, it isn't cached" % nick)
+                        continue
+                    pending.append((nick, copy.deepcopy(account)))
+                self.dirty.clear()
+            try:
+                self.backend.put_accounts(pending)
+            except Exception, err:
+                print("Failed to save accounts: %s" % err)
+                with self.lock: # try again on the next flush
+                    self.dirty.update(nick for nick, account in pending)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            if self.closed:
+                return
+            self.flush()
+
+    def close(self):
+        """
+        Writes what is left and stops the flush thread
+        """
+        self.closed = True
+        self.flush()
+
+    def __len__(self):
+        return len(self.cache)
@@ -0,0 +1,269 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+from server import Server
+from client import Client
+from channel import Channel
+
+# Microbenchmarks for the server hot paths
+# Every benchmark runs the real Server, Client and Channel code against
+# in memory sockets at every member count in --sizes
+# Example: python bench.py --output results/`git describe --always`.json
+#          python bench.py --compare results/old.json
+#
+# Results are json: {"benchmarks": {name: {size: {"ops", "best_us", ...}}}}
+# so runs of two versions can be compared with --compare
+
+SIZES = (10, 100, 1000, 10000)
+
+
+class FakeSocket:
+    """
+    In memory client socket, takes everything sent to it
+    """
+    def __init__(self, ip):
+        self.ip = ip
+        self.sent = 0
+
+    def getpeername(self):
+        return (self.ip, 5050)
+
+    def send(self, data, flags=0):
+        self.sent += len(data)
+        return len(data)
+
+    def fileno(self):
+        return -1
+
+    def shutdown(self, how):
+        pass
+
+    def close(self):
+        pass
+
+
+class Quiet:
+    """
+    Hides what the server prints while a benchmark runs
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def make_server():
+    server = Server()
+    server.CONFIG["RATE_LIMITS"] = {} # measure the work, not flood control
+    return server
+
+
+def make_client(server, number, nick=None):
+    """
+    Connects a client with a fake socket and gives it a nick
+    """
+    ip = "10.%d.%d.%d" % (number >> 16 & 255, number >> 8 & 255, number & 255)
+    client = Client(FakeSocket(ip), server)
+    server.register_client(client)
+    client.picked_nick = client.set_nick(client, nick or "u%d" % number)
+    return client
+
+
+def make_channel(server, members, name="#bench"):
+    """
+    Creates a channel with `members` clients in it
+    Returns the channel and its clients
+    """
+    channel = server.channels[name] = Channel(server, name, {}, "")
+    clients = []
+    for number in range(members):
+        client = make_client(server, number)
+        # what on_join does minus telling everyone, that's O(n^2)
+        channel.clients.append(client)
+        channel.users[client.nick] = client
+        client.channels[name] = channel
+        clients.append(client)
+    return channel, clients
+
+
+def timed(function, count):
+    start = time.time()
+    for i in xrange(count):
+        function(i)
+    return time.time() - start
+
+# Benchmarks: setup(size) returns (server, run), run(count) does `count`
+# operations and returns how long the timed part took
+
+
+def channel_on_message(size):
+    server = make_server()
+    channel, clients = make_channel(server, size)
+    sender = clients[0]
+    return server, lambda count: timed(
+        lambda i: channel.on_message(sender, "hello world %d" % i), count)
+
+
+def channel_writeline(size):
+    server = make_server()
+    channel, clients = make_channel(server, size)
+    data = json.dumps({"type": "SERVERMSG", "message": "hello world"})
+    return server, lambda count: timed(lambda i: channel.writeline(data), count)
+
+
+def server_find_nick(size):
+    server = make_server()
+    for number in range(size):
+        make_client(server, number)
+    nicks = ["U%d" % (number % size) for number in range(1000)]
+    return server, lambda count: timed(
+        lambda i: server.find_nick(nicks[i % len(nicks)]), count)
+
+
+def server_register_client(size):
+    server = make_server()
+    for number in range(size):
+        make_client(server, number)
+    def run(count):
+        clients = [Client(FakeSocket("192.168.0.1"), server)
+                   for i in xrange(count)]
+        elapsed = timed(lambda i: server.register_client(clients[i]), count)
+        for client in clients:
+            server.remove_client(client)
+        return elapsed
+    return server, run
+
+
+def client_set_nick(size):
+    server = make_server()
+    channel, clients = make_channel(server, size)
+    client = clients[0]
+    nicks = ["renamed", clients[0].nick] # flip between two nicks
+    return server, lambda count: timed(
+        lambda i: client.set_nick(client, nicks[i % 2]), count)
+
+
+def channel_on_join(size):
+    server = make_server()
+    channel, clients = make_channel(server, size)
+    client = make_client(server, size)
+    def run(count):
+        elapsed = 0
+        for i in xrange(count): # part right away so the channel stays at `size`
+            start = time.time()
+            channel.on_join(client)
+            elapsed += time.time() - start
+            channel.on_part(client, "bye")
+        return elapsed
+    return server, run
+
+
+BENCHMARKS = [
+    channel_on_message,
+    channel_writeline,
+    server_find_nick,
+    server_register_client,
+    client_set_nick,
+    channel_on_join,
+]
+
+
+def measure(setup, size, repeat, budget):
+    """
+    Runs a benchmark `repeat` times
+    The op count is picked so one run takes about `budget` seconds
+    """
+    server, run = setup(size)
+    count = 1
+    while True: # calibrate, this also warms up
+        elapsed = run(count)
+        if elapsed >= budget / 10 or count >= 100000:
+            break
+        count *= 10
+    count = max(1, int(count * budget / max(elapsed, 1e-9)))
+    times = sorted(run(count) / count for i in range(repeat))
+    server.accounts.close()
+    return {
+        "ops": count,
+        "repeat": repeat,
+        "best_us": times[0] * 1e6,
+        "median_us": times[len(times) // 2] * 1e6,
+        "ops_per_sec": 1 / times[0] if times[0] else None
+    }
+
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, old):
+    """
+    Prints how much faster or slower each benchmark got
+    """
+    print("\nagainst %s" % old.get("version"))
+    for name, sizes in sorted(results["benchmarks"].items()):
+        for size, result in sorted(sizes.items(), key=lambda item: int(item[0])):
+            before = old.get("benchmarks", {}).get(name, {}).get(size)
+            if not before:
+                continue
+            change = result["best_us"] / before["best_us"] - 1
+            print("%-24s %6s %+7.1f%%%s" % (name, size, change * 100,
+                "  slower" if change > 0.1 else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the server hot paths")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES)),
+                        help="member counts to run at")
+    parser.add_argument("--only", help="comma separated benchmarks to run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=0.2,
+                        help="seconds per run")
+    parser.add_argument("--output", help="save the results as json")
+    parser.add_argument("--compare", help="results of an earlier run")
+    options = parser.parse_args()
+    os.chdir(ROOT) # the server reads config.json and the lists from here
+
+    sizes = [int(size) for size in options.sizes.split(",")]
+    benchmarks = BENCHMARKS
+    if options.only:
+        names = options.only.split(",")
+        benchmarks = [setup for setup in BENCHMARKS if setup.__name__ in names]
+    results = {
+        "version": version(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": int(time.time()),
+        "benchmarks": {}
+    }
+    for setup in benchmarks:
+        for size in sizes:
+            with Quiet():
+                result = measure(setup, size, options.repeat, options.budget)
+            results["benchmarks"].setdefault(setup.__name__, {})[str(size)] = result
+            print("%-24s %6d %12.2f us %12.2f us median" % (setup.__name__, size,
+                result["best_us"], result["median_us"]))
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, sort_keys=True, indent=4, separators=(',', ': '))
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
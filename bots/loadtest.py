@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import time
+import errno
+import heapq
+import random
+import select
+import socket
+import argparse
+import resource
+import itertools
+
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import errorcodes
+
+# Load test for a local AwwRC server
+# Connects --clients simulated users at --connect-rate a second. Each one
+# picks a nick (registers it with --register), joins --joins of the --channels load test
+# channels and says something every 1/--rate seconds until --duration
+# seconds after the last user joined, then they all quit.
+# Example: python loadtest.py --clients 500 --rate 1 --pid `pgrep -f main.py`
+#
+# The simulated users are limited like everybody else. Add 127.0.0.1 to
+# ilines.txt and raise SERVER_MAX_USERS, CONNECT_RATE_TOTAL and the
+# "message", "join" and "channel" RATE_LIMITS to test more than a
+# handful of users.
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+RATE_LIMITED = errorcodes.get("rate limited")
+
+
+def percentiles(samples):
+    """
+    Returns the p50, p90, p99 and max of a list of seconds, in ms
+    """
+    if not samples:
+        return None
+    samples = sorted(samples)
+    pick = lambda p: samples[min(len(samples) - 1, int(len(samples) * p))] * 1000
+    return {
+        "p50": pick(0.5),
+        "p90": pick(0.9),
+        "p99": pick(0.99),
+        "max": samples[-1] * 1000
+    }
+
+
+def rss(pid):
+    """
+    Returns the resident memory of process `pid` in bytes or None
+    """
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return None
+
+
+class SimClient:
+    """
+    One simulated user, driven by the LoadTest event loop
+    """
+    def __init__(self, test, number):
+        self.test = test
+        self.nick = "%s%d" % (test.tag, number)
+        self.channels = sorted(set(test.channel(number + i)
+                                   for i in range(test.options.joins)))
+        self.state = "connecting"
+        self.inbox = ""
+        self.outbox = ""
+        self.joined = 0
+        self.started = time.time()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        err = self.sock.connect_ex((test.options.host, test.options.port))
+        if err not in (0, errno.EINPROGRESS):
+            self.sock.close()
+            raise socket.error(err, os.strerror(err))
+        self.fd = self.sock.fileno()
+
+    def fileno(self):
+        return self.fd
+
+    def send(self, line):
+        self.outbox += line + "\n"
+        if self.state != "connecting":
+            self.flush()
+
+    def flush(self):
+        try:
+            sent = self.sock.send(self.outbox)
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                sent = 0
+            else:
+                return self.test.drop(self, "dropped")
+        self.outbox = self.outbox[sent:]
+        self.test.watch(self, bool(self.outbox))
+
+    def on_writable(self):
+        if self.state == "connecting":
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                return self.test.drop(self, "failed")
+            self.state = "greeting"
+        self.flush()
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            return self.test.drop(self, "closed" if self.state == "quitting"
+                                  else "dropped")
+        self.test.counters["bytes_in"] += len(data)
+        lines = (self.inbox + data).split("\n")
+        self.inbox = lines.pop()
+        for line in lines:
+            if self.test.clients.get(self.fd) is not self:
+                return # dropped by an earlier line
+            if line.startswith("{"): # the server also sends plain text
+                self.on_frame(json.loads(line))
+
+    def on_frame(self, frame):
+        kind = frame.get("type")
+        if kind == "PICKNICK" and self.state == "greeting":
+            self.test.connect_latency.append(time.time() - self.started)
+            self.state = "nick"
+            self.send(self.nick)
+        elif kind == "NICK" and self.state == "nick":
+            self.state = "joining"
+            if self.test.options.register:
+                self.send("register %s %s@loadtest" % (self.nick, self.nick))
+            for channel in self.channels:
+                self.send("chanjoin %s" % channel)
+        elif kind == "YOUJOIN" and self.state == "joining":
+            self.joined += 1
+            self.test.members[frame["channel"]] += 1
+            if self.joined == len(self.channels):
+                self.state = "chatting"
+                self.test.ready(self)
+        elif kind == "CHANMSG":
+            words = frame.get("message", "").split(" ")
+            if words[0] == "lt" and len(words) > 1:
+                self.test.counters["delivered"] += 1
+                self.test.delivery_latency.append(time.time() - float(words[1]))
+        elif kind == "CHANERROR": # sending too fast, channel too busy, bad words...
+            self.test.counters["refused"] += 1
+        elif kind == "ERROR":
+            if frame.get("code") == RATE_LIMITED:
+                self.test.counters["rate_limited"] += 1
+            else:
+                self.test.counters["errors"] += 1
+                if self.state == "nick": # nick taken or not allowed
+                    self.test.drop(self, "failed")
+
+    def message(self):
+        """
+        Says something in one of the joined channels
+        """
+        channel = random.choice(self.channels)
+        text = "lt %.6f %s" % (time.time(), self.nick)
+        if len(text) < self.test.options.size:
+            text += " " + "x" * (self.test.options.size - len(text) - 1)
+        self.send("chanmsg %s %s" % (channel, text))
+        self.test.counters["sent"] += 1
+        # members the sender knows about, users joining at the same time
+        # can get the message too
+        self.test.counters["expected"] += self.test.members[channel]
+
+
+class LoadTest:
+    """
+    Runs every simulated client from one epoll loop so thousands of
+    them fit in one process without skewing the latencies with threads
+    """
+    def __init__(self, options):
+        self.options = options
+        self.tag = "lt%s" % "".join(random.choice("abcdefghijklmnopqrstuvwxyz")
+                                    for _ in range(3))
+        self.poll = select.epoll()
+        self.clients = {} # fd -> SimClient
+        self.timers = [] # heap of (when, n, function, args)
+        self.order = itertools.count()
+        self.members = defaultdict(int) # channel -> ready users
+        self.counters = defaultdict(int)
+        self.connect_latency = []
+        self.delivery_latency = []
+        self.memory = []
+        self.first_ready = None
+        self.quitting = False
+
+    def channel(self, number):
+        return "#load%d" % (number % self.options.channels)
+
+    def at(self, when, function, *args):
+        heapq.heappush(self.timers, (when, next(self.order), function, args))
+
+    def watch(self, client, writable):
+        if client.fileno() in self.clients:
+            events = select.EPOLLIN | (select.EPOLLOUT if writable else 0)
+            self.poll.modify(client.fileno(), events)
+
+    def drop(self, client, reason):
+        if self.clients.get(client.fileno()) is not client:
+            return
+        del self.clients[client.fileno()]
+        self.counters[reason] += 1
+        self.poll.unregister(client.fileno())
+        if client.state == "chatting":
+            for channel in client.channels:
+                self.members[channel] -= 1
+        client.state = reason
+        client.sock.close()
+
+    def connect(self, number):
+        try:
+            client = SimClient(self, number)
+        except socket.error:
+            self.counters["failed"] += 1
+            return
+        self.clients[client.fileno()] = client
+        self.poll.register(client.fileno(), select.EPOLLIN | select.EPOLLOUT)
+        self.at(time.time() + self.options.timeout, self.check_ready, client)
+
+    def check_ready(self, client):
+        if client.state in ("connecting", "greeting", "nick", "joining"):
+            self.drop(client, "timed_out")
+
+    def ready(self, client):
+        if self.first_ready is None:
+            self.first_ready = time.time()
+        if self.options.rate > 0:
+            interval = 1.0 / self.options.rate
+            self.at(time.time() + random.uniform(0, interval), self.chat, client)
+
+    def chat(self, client):
+        if client.state != "chatting" or time.time() >= self.stop_chat:
+            return
+        client.message()
+        self.at(time.time() + 1.0 / self.options.rate, self.chat, client)
+
+    def sample_memory(self):
+        memory = rss(self.options.pid)
+        if memory is not None:
+            self.memory.append(memory)
+        if not self.quitting:
+            self.at(time.time() + 1, self.sample_memory)
+
+    def quit(self):
+        self.quitting = True
+        for client in self.clients.values():
+            client.send("quit")
+            client.state = "quitting"
+        self.at(time.time() + self.options.timeout, self.give_up)
+
+    def give_up(self):
+        for client in self.clients.values():
+            self.drop(client, "closed")
+
+    def run(self):
+        start = time.time()
+        ramp = self.options.clients / float(self.options.connect_rate)
+        self.stop_chat = start + ramp + self.options.duration
+        for number in range(self.options.clients):
+            self.at(start + number / float(self.options.connect_rate),
+                    self.connect, number)
+        self.at(self.stop_chat + self.options.drain, self.quit)
+        if self.options.pid:
+            self.sample_memory()
+        while self.timers or self.clients:
+            timeout = 0.1
+            if self.timers:
+                timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+            for fd, event in self.poll.poll(timeout):
+                # writable first, it finishes the connect before the
+                # greeting is read
+                client = self.clients.get(fd)
+                if client and event & select.EPOLLOUT:
+                    client.on_writable()
+                client = self.clients.get(fd)
+                if client and event & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                    client.on_readable()
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                when, _, function, args = heapq.heappop(self.timers)
+                function(*args)
+        if self.options.pid:
+            self.sample_memory()
+        return self.report()
+
+    def report(self):
+        chatted = max(self.stop_chat - (self.first_ready or self.stop_chat), 0.001)
+        counters = self.counters
+        return {
+            "clients": self.options.clients,
+            "nick_prefix": self.tag, # every nick of this run starts with it
+            "registered": self.options.register,
+            "connected": len(self.connect_latency),
+            "failed": counters["failed"],
+            "timed_out": counters["timed_out"],
+            "dropped": counters["dropped"],
+            "connect_ms": percentiles(self.connect_latency),
+            "delivery_ms": percentiles(self.delivery_latency),
+            "sent": counters["sent"],
+            "delivered": counters["delivered"],
+            "expected": counters["expected"],
+            "rate_limited": counters["rate_limited"],
+            "refused": counters["refused"],
+            "errors": counters["errors"],
+            "throughput": {
+                "sent_per_sec": counters["sent"] / chatted,
+                "delivered_per_sec": counters["delivered"] / chatted,
+                "bytes_in_per_sec": counters["bytes_in"] / chatted
+            },
+            "server_rss": {
+                "start": self.memory[0],
+                "peak": max(self.memory),
+                "end": self.memory[-1]
+            } if self.memory else None
+        }
+
+
+def print_report(report):
+    print("clients    %(connected)d/%(clients)d connected, %(failed)d failed, "
+          "%(timed_out)d timed out, %(dropped)d dropped" % report)
+    for name in ("connect_ms", "delivery_ms"):
+        if report[name]:
+            print("%-10s p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % (name,
+                  report[name]["p50"], report[name]["p90"],
+                  report[name]["p99"], report[name]["max"]))
+    print("messages   %(sent)d sent, %(delivered)d/%(expected)d delivered, "
+          "%(rate_limited)d rate limited, %(refused)d refused by channels, "
+          "%(errors)d errors" % report)
+    print("throughput %(sent_per_sec).1f sent/s, %(delivered_per_sec).1f "
+          "delivered/s, %(bytes_in_per_sec).0f bytes/s" % report["throughput"])
+    if report["registered"]:
+        print("accounts   registered as %(nick_prefix)s*, with json storage "
+              "remove them with rm accounts/%(nick_prefix)s*.json" % report)
+    if report["server_rss"]:
+        print("server rss %s" % ", ".join("%s %.1fMB" % (name, report["server_rss"][name] / 1048576.0)
+                                          for name in ("start", "peak", "end")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test an AwwRC server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5050)
+    parser.add_argument("--clients", type=int, default=100,
+                        help="simulated users")
+    parser.add_argument("--connect-rate", type=float, default=50,
+                        help="new connections a second")
+    parser.add_argument("--channels", type=int, default=10,
+                        help="load test channels to spread the users over")
+    parser.add_argument("--joins", type=int, default=1,
+                        help="channels every user joins")
+    parser.add_argument("--rate", type=float, default=0.5,
+                        help="messages a second per user")
+    parser.add_argument("--size", type=int, default=0,
+                        help="pad messages to this many bytes")
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds to chat once every user connected")
+    parser.add_argument("--drain", type=float, default=2,
+                        help="seconds to wait for late messages before quitting")
+    parser.add_argument("--timeout", type=float, default=10,
+                        help="seconds a user has to connect and join")
+    parser.add_argument("--register", action="store_true",
+                        help="register the nicks too, this leaves an account "
+                             "behind on the server for every user")
+    parser.add_argument("--pid", type=int,
+                        help="server process to watch the memory of")
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as json")
+    options = parser.parse_args()
+
+    # every simulated user needs a socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < options.clients + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    report = LoadTest(options).run()
+    if options.json:
+        print(json.dumps(report, indent=4, sort_keys=True))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
+import time
 import json
 import errorcodes
 
-from collections import defaultdict
+from collections import deque
+from flags import FlagSet, valid
+from iptrie import IPTrie
+from ratelimit import RateLimiter
+from history import HistoryLog
+from wordfilter import WordFilter
 
-class Channel:
+class Channel(object):
     """
     flags:
         n = No outside message
@@ -18,23 +24,35 @@ class Channel:
         R = Only registered clients can join
         m = only users with v or o and talk
     """
-    def __init__(self, server, name, flags={}, topic="", banlist=[],
-        ops=[], owner="", badwords=[], public_notes=[], op_notes=[]):
+    support_flags = "nmklOFpGPBR"
+
+    __slots__ = ("server", "name", "flags", "clients", "users", "user_flags",
+                 "topic", "banlist", "bans", "ops", "owner", "badwords",
+                 "badword_filter", "limits", "broadcasts", "messages",
+                 "history", "public_notes", "op_notes")
+
+    def __init__(self, server, name, flags=None, topic="", banlist=None,
+        ops=None, owner="", badwords=None, public_notes=None, op_notes=None):
         self.server = server
         self.name = name
-        self.flags = flags
+        self.flags = dict(flags or {}) # copies, channels never share lists
         self.clients = []
         self.users = {}
-        self.user_flags = defaultdict(list)
+        self.user_flags = {} # nick -> FlagSet, only nicks with a flag
         self.topic = topic[0:self.server.CONFIG["CHAN_TOPIC_LIMIT"]]
-        self.banlist = banlist
-        self.ops = ops
+        self.banlist = list(banlist or ())
+        self.update_bans() # sets bans, the lookup for banlist
+        self.ops = list(ops or ())
         self.owner = owner
-        self.badwords = badwords
-        self.messages = []
-        self.public_notes = public_notes
-        self.op_notes = op_notes
-        self.support_flags = list("nmklOFpGPBR")
+        self.badwords = list(badwords or ())
+        self.compile_badwords()
+        self.limits = RateLimiter() # total output, see RATE_LIMITS channel_total
+        self.broadcasts = 0 # lines sent to everyone in the channel
+        # Encoded CHANMSGs for playback, holds the last P lines
+        self.messages = deque(maxlen=self.playback_size())
+        self.history = None # HistoryLog, opened when first used
+        self.public_notes = list(public_notes or ())
+        self.op_notes = list(op_notes or ())
 
     def add_client(self, client):
         self.clients.append(client)
@@ -56,14 +74,77 @@ class Channel:
             "userlist": self.users.keys()
         }))
         if self.flags.get("P"): # if playback is enabled
-            self.playback(client, amount=self.flags.get("P"))
+            self.playback(client, amount=self.playback_size())
 
     def playback(self, client, amount=10):
         """
         Send the last x lines to clinet
         """
-        for msg in self.messages[-abs(amount):]:
-            client.writeline(msg)
+        history = self.get_history()
+        if history:
+            data = history.tail(abs(amount))
+            if data:
+                client.send_raw(data)
+            return
+        # list() copies the deque in one step so other threads can
+        # keep adding messages, it never holds more than P lines
+        for msg in list(self.messages)[-abs(amount):]:
+            client.send_raw(msg)
+
+    def playback_size(self):
+        """
+        Returns how many lines of playback to keep
+        The `P` flag capped by CHAN_PLAYBACK_LIMIT, 0 if `P` isn't set
+        """
+        try:
+            amount = abs(int(self.flags.get("P", 0)))
+        except (TypeError, ValueError):
+            amount = 0
+        return min(amount, self.server.CONFIG["CHAN_PLAYBACK_LIMIT"])
+
+    def get_history(self):
+        """
+        Returns the on disk history log of this channel
+        None if CHAN_HISTORY is off
+        """
+        if not self.server.CONFIG["CHAN_HISTORY"]:
+            return None
+        if self.history is None:
+            with self.server.lock:
+                if self.history is None:
+                    self.history = HistoryLog(
+                        self.server.CONFIG["CHAN_HISTORY_PATH"], self.name)
+        return self.history
+
+    def update_bans(self):
+        """
+        Rebuilds the banlist lookup, supports CIDR ranges
+        None while the banlist is empty
+        """
+        self.bans = IPTrie(self.banlist) if self.banlist else None
+
+    def is_banned(self, ip):
+        return self.bans is not None and ip in self.bans
+
+    def compile_badwords(self):
+        """
+        Compiles the badword list into one filter, runs every time
+        the list changes. None while the list is empty
+        """
+        if not self.badwords:
+            self.badword_filter = None
+            return
+        self.badword_filter = WordFilter(self.badwords,
+            self.server.CONFIG["CHAN_BADWORD_IGNORE_CASE"],
+            self.server.CONFIG["CHAN_BADWORD_WHOLE_WORDS"])
+
+    def resize_playback(self):
+        """
+        Resizes the playback history after `P` was changed
+        """
+        size = self.playback_size()
+        if size != self.messages.maxlen:
+            self.messages = deque(self.messages, maxlen=size)
 
     def on_join(self, client, key=None):
         """
@@ -93,7 +174,7 @@ class Channel:
                     "message": "You must be registered and logged in to join %s" % self.name
                 }))
                 return False
-        if client.ip not in self.banlist:
+        if not self.is_banned(client.ip):
             if self.flags.get('O'):
                 if client.is_oper():
                     self.add_client(client)
@@ -149,6 +230,7 @@ class Channel:
         """
         del self.users[client.nick]
         self.clients.remove(client)
+        self.user_flags.pop(client.nick, None)
         self.writeline(json.dumps({
             "type": "CHANPART",
             "channel": self.name,
@@ -160,8 +242,14 @@ class Channel:
     def on_quit(self, client, message):
         """
         Runs when a client quits the server
-        Currently does nothing
-        """
+        Removes the client from the channel and displays their
+        quit message
+        """
+        if client in self.clients:
+            self.clients.remove(client)
+        if self.users.get(client.nick) is client:
+            del self.users[client.nick]
+            self.user_flags.pop(client.nick, None)
         self.writeline(json.dumps({
             "type": "QUIT",
             "channel": self.name,
@@ -170,6 +258,16 @@ class Channel:
             "message": message
         }))
 
+    def on_nick(self, client, old_nick):
+        """
+        Runs when a client in the channel changes their nick
+        """
+        if self.users.get(old_nick) is client:
+            del self.users[old_nick]
+            self.users[client.nick] = client
+        if old_nick in self.user_flags:
+            self.user_flags[client.nick] = self.user_flags.pop(old_nick)
+
     def kick_user(self, client, nick, reason):
         """
         Removes a user from the channel
@@ -182,6 +280,7 @@ class Channel:
                 self.users[nick].on_kick(self, reason)
                 self.clients.remove(self.users[nick])
                 del self.users[nick]
+                self.user_flags.pop(nick, None)
                 self.writeline(json.dumps({
                     "type": "CHANKICK",
                     "channel": self.name,
@@ -211,6 +310,7 @@ class Channel:
             if self.is_op(client):
                 self.users[nick].on_ban(self)
                 self.banlist.append(self.users[nick].ip)
+                self.update_bans()
                 self.writeline(json.dumps({
                     "type": "CHANBAN",
                     "channel": self.name,
@@ -239,6 +339,7 @@ class Channel:
         if self.is_op(client):
             if ip in self.banlist:
                 self.banlist.remove(ip)
+                self.update_bans()
                 self.writeline("UNBAN %s was unbanned from %s" % (ip, self.name))
                 self.writeline(json.dumps({
                     "type": "CHANUNBAN",
@@ -285,112 +386,103 @@ class Channel:
         messages from the channel otherwise it will send the clients
         message to everyone in the channel
         """
-        if client.ip in self.banlist: # if the user is banned
+        if self.is_banned(client.ip): # if the user is banned
             client.writeline(json.dumps({
                 "type": "YOUCHANBANNED",
                 "channel": self.name,
                 "message": "You are banned from %s" % self.name
             }))
             return
-        elif self.flags.get("m"):
-            if 'v' not in self.user_flags[client.nick] or not self.is_op(client):
+        if self.flags.get("m"):
+            if 'v' not in self.user_flags.get(client.nick, ()) and not self.is_op(client):
                 client.writeline(json.dumps({
                     "type": "CHANERROR",
                     "channel": self.name,
                     "message": "%s is +m. you need +v or +o to talk in this channel" % self.name
                 }))
                 return
-        elif self.flags.get('G'): # if badwords enabled
-            badword = False
-            for bw in self.badwords:
-                print bw
-                if bw in message:
-                    badword = True
-            if badword:
+        if self.flags.get('G') and self.badword_filter: # if badwords enabled
+            found = self.badword_filter.find(message)
+            if found:
                 client.writeline(json.dumps({
                     "type": "CHANERROR",
                     "channel": self.name,
-                    "message": "You said a bad word. '%s'" % bw
+                    "message": "You said a bad word. '%s'" % "', '".join(found)
                 }))
-            else:
-                self.writeline(json.dumps({
-                    "type": "CHANMSG",
+                return
+        if self.flags.get("n"): # if flag 'n' is set
+            if self.name not in client.channels:
+                client.writeline(json.dumps({
+                    "type": "CHANERROR",
                     "channel": self.name,
-                    "nick": client.nick,
-                    "ip": client.ip,
-                    "message": message
+                    "message": "no outside messages"
                 }))
-                if self.flags.get("P"):
-                    self.messages.append(json.dumps({
-                        "type": "CHANMSG",
-                        "channel": self.name,
-                        "nick": client.nick,
-                        "ip": client.ip,
-                        "message": message
-                    }))
-        else:
-            if self.flags.get("n"): # if flag 'n' is set
-                if client in self.clients:
-                    self.writeline(json.dumps({
-                        "type": "CHANMSG",
-                        "channel": self.name,
-                        "nick": client.nick,
-                        "ip": client.ip,
-                        "message": message
-                    }))
-                    if self.flags.get("P"):
-                        self.messages.append(json.dumps({
-                            "type": "CHANMSG",
-                            "channel": self.name,
-                            "nick": client.nick,
-                            "ip": client.ip,
-                            "message": message
-                        }))
-                else:
-                    client.writeline(json.dumps({
-                        "type": "CHANERROR",
-                        "channel": self.name,
-                        "message": "no outside messages"
-                    }))
-            else:
-                self.writeline(json.dumps({
-                    "type": "CHANMSG",
+                return
+        # Every delivery to a member counts against the senders output
+        # limit first, so one client can't use up the channels total
+        if not client.is_oper():
+            limits = self.server.CONFIG["RATE_LIMITS"]
+            if not client.limits.allow(limits, "channel", len(self.clients)):
+                client.writeline(json.dumps({
+                    "type": "CHANERROR",
                     "channel": self.name,
-                    "nick": client.nick,
-                    "ip": client.ip,
-                    "message": message
+                    "message": "You're sending to %s too fast, your message was dropped" % self.name
                 }))
-                if self.flags.get("P"):
-                    self.messages.append(json.dumps({
-                        "type": "CHANMSG",
-                        "channel": self.name,
-                        "nick": client.nick,
-                        "ip": client.ip,
-                        "message": message
-                    }))
+                return
+            if not self.limits.allow(limits, "channel_total", len(self.clients)):
+                client.writeline(json.dumps({
+                    "type": "CHANERROR",
+                    "channel": self.name,
+                    "message": "%s is too busy, your message was dropped" % self.name
+                }))
+                return
+        # Encode the message once, every member and the playback
+        # history share the same data
+        data = json.dumps({
+            "type": "CHANMSG",
+            "channel": self.name,
+            "nick": client.nick,
+            "ip": client.ip,
+            "message": message
+        }) + '\n'
+        self.broadcast(data)
+        if self.flags.get("P") and self.get_history():
+            self.history.append(data)
+        else:
+            self.messages.append(data) # dropped right away if `P` isn't set
 
     def writeline(self, message):
         """
         Sends a message to all users in this channel
         """
+        self.broadcast(message.strip() + '\n')
+
+    def broadcast(self, data):
+        """
+        Sends already encoded data to all users in this channel
+        """
+        start = time.time()
         for client in self.clients:
             try:
-                client.writeline(message)
+                client.send_raw(data)
             except:
                 self.on_part(client, "error")
-                client.quit("client error")
+                client.quit("client error", "error")
+        self.broadcasts += 1
+        self.server.fanout.record(time.time() - start)
 
     def message_ops(self, message):
         """
         Send a message to all ops on the channel
         """
+        data = message.strip() + '\n'
         for client in self.clients:
             if self.is_op(client):
                 try:
-                    client.writeline(message)
+                    client.send_raw(data)
                 except:
                     self.on_part(client, "error")
-                    client.quit("client error")
+                    client.quit("client error", "error")
 
     def is_op(self, client):
         """
@@ -400,9 +492,9 @@ class Channel:
         Returns True if: client is a server admin/oper
         """
         if client.logged_in():
-            return client.account["uuid"] in self.ops or "o" in self.user_flags[client.nick] or client.is_oper()
+            return client.account["uuid"] in self.ops or "o" in self.user_flags.get(client.nick, ()) or client.is_oper()
         else:
-            return client.is_oper() or "o" in self.user_flags[client.nick]
+            return client.is_oper() or "o" in self.user_flags.get(client.nick, ())
 
     def is_owner(self, client):
         """
@@ -422,6 +514,13 @@ class Channel:
               they must have an account with the server
         """
         if self.is_owner(client):
+            if not self.server.accounts.get_by_uuid(users_uuid):
+                client.writeline(json.dumps({
+                    "type": "CHANERROR",
+                    "channel": self.name,
+                    "message": "no account has that uuid"
+                }))
+                return
             self.ops.append(users_uuid)
             self.save()
         else:
@@ -439,6 +538,8 @@ class Channel:
         if self.is_op(client):
             if flag in self.support_flags:
                 self.flags[flag] = arg
+                if flag == "P":
+                    self.resize_playback()
             else:
                 pass
         else:
@@ -456,6 +557,8 @@ class Channel:
         if self.is_op(client):
             if flag in self.flags:
                 del self.flags[flag]
+                if flag == "P":
+                    self.resize_playback()
             else:
                 pass
         else:
@@ -475,9 +578,15 @@ class Channel:
         nick: nick to add flag to
         """
         if self.is_op(client):
-            if nick in self.users:
+            if not valid(flag):
+                client.writeline(json.dumps({
+                    "type": "CHANERROR",
+                    "channel": self.name,
+                    "message": "flags are one letter"
+                }))
+            elif nick in self.users:
                 # self.users[nick].flags.append(self.name + "|" + flag)
-                self.user_flags[nick].append(flag)
+                self.user_flags.setdefault(nick, FlagSet()).add(flag)
                 self.writeline(json.dumps({
                     "type": "CHANFLAG",
                     "channel": self.name,
@@ -506,10 +615,13 @@ class Channel:
         nick: nick to remove flag from
         """
         if self.is_op(client):
-            if nick in self.clients:
+            if nick in self.users:
                 # self.users[nick].flags.remove(self.name + "|" + flag)
-                if flag in self.user_flags[nick]:
-                    self.user_flags[nick].remove(flag)
+                flags = self.user_flags.get(nick)
+                if flags and flag in flags:
+                    flags.discard(flag)
+                    if not flags:
+                        del self.user_flags[nick]
                     self.writeline(json.dumps({
                         "type": "CHANFLAG",
                         "channel": self.name,
@@ -538,6 +650,7 @@ class Channel:
             if len(self.badwords) < self.server.CONFIG["CHAN_BADWORD_LIMIT"]:
                 if not badword in self.badwords:
                     self.badwords.append(badword)
+                    self.compile_badwords()
                     client.writeline(json.dumps({
                         "type": "SERVERMSG",
                         "message": "You added a badword to %s" % self.name
@@ -546,7 +659,7 @@ class Channel:
                     client.writeline(json.dumps({
                         "type": "CHANERROR",
                         "channel": self.name,
-                        "message": "%s is already in badword list" % ()
+                        "message": "%s is already in badword list" % badword
                     }))
             else:
                 client.writeline(json.dumps({
@@ -568,6 +681,7 @@ class Channel:
         if self.is_op(client):
             if badword in self.badwords:
                 self.badwords.remove(badword)
+                self.compile_badwords()
                 client.writeline(json.dumps({
                     "type": "SERVERMSG",
                     "message": "%s removed from %s's badword list" % (badword, self.name)
@@ -624,7 +738,7 @@ class Channel:
 
     def save(self):
         """
-        Saves the channel vars into a json file
+        Saves the channel vars to storage
         """
         cvars = {
             "name": self.name,
@@ -637,5 +751,4 @@ class Channel:
             "public_notes": self.public_notes,
             "op_notes": self.op_notes
         }
-        with open("channels/%s.json" % self.name, 'w') as f:
-            f.write(json.dumps(cvars, sort_keys=True, indent=4, separators=(',', ': ')))
+        self.server.storage.put_channels([(self.name, cvars)])
@@ -6,15 +6,24 @@ import json
 import hashlib
 import uuid
 import os
+import errno
 
+from collections import deque
 
 import errorcodes  # Local Import
+from flags import FlagSet
+from ratelimit import RateLimiter
+from commands import Command, CommandRegistry
+import metrics
+from metrics import BUCKETS
 
 
-class Client(threading.Thread):
+class Client(object):
 
     '''
-    Class that implements the client threads in this server
+    One connection to the server. The thread engine reads from it in its
+    own thread (see start), the event engine from the event loop.
+    Slotted so an idle connection costs as little as possible
     Client Modes:
     B = Bot
     O = Oper
@@ -22,18 +31,53 @@ class Client(threading.Thread):
     w = receives oper messages
     '''
 
+    __slots__ = ("client", "server", "thread", "ip", "real_ip", "nick",
+                 "channels", "account", "flags", "picked_nick", "outbox",
+                 "outbox_size", "out_lock", "watched", "evicted", "closed",
+                 "inbuf", "inview", "instart", "inend", "discarding",
+                 "limits", "lines_in", "bytes_in", "lines_out", "bytes_out")
+
     def __init__(self, client_sock, server):
         '''
-        Initialize the object, save the socket that this thread will use.
+        Initialize the object, save the socket that this client will use.
         '''
-        threading.Thread.__init__(self)
         self.client = client_sock
         self.server = server
+        self.thread = None # reader thread in the thread engine
         self.ip = self.client.getpeername()[0]  # Get the clients IP address
+        self.real_ip = self.ip # self.ip changes when an oper vhost is set
         self.nick = str(uuid.uuid4())
         self.channels = {}
         self.account = None
-        self.flags = self.server.CONFIG["DEFAULT_CLIENT_FLAGS"]
+        self.flags = FlagSet(self.server.CONFIG["DEFAULT_CLIENT_FLAGS"])
+        self.picked_nick = False
+        self.outbox = deque() # data waiting to be sent
+        self.outbox_size = 0
+        self.out_lock = threading.Lock()
+        self.watched = False # True while the writer waits to flush the outbox
+        self.evicted = False
+        self.closed = False
+        # Receive buffer, holds unfinished lines between reads
+        # Only held while there is data in it, drained buffers go back
+        # to the servers pool, see fill and next_line
+        self.inbuf = None
+        self.inview = None
+        self.instart = 0 # start of the first unread line
+        self.inend = 0 # end of the data in the buffer
+        self.discarding = False # True while skipping a line that is too long
+        self.limits = RateLimiter() # flood control, see RATE_LIMITS
+        # Traffic counters, see metrics.TRAFFIC
+        self.lines_in = 0
+        self.bytes_in = 0
+        self.lines_out = 0
+        self.bytes_out = 0
+
+    def start(self):
+        """
+        Reads from the client in a thread of its own (thread engine)
+        """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
 
     def run(self):
         '''
@@ -41,312 +85,54 @@ class Client(threading.Thread):
         and dies.
         '''
         try:
-            # client needs to change their nick
-            self.writeline(json.dumps({
-                "type": "PICKNICK"
-            }))
-            self.set_nick(self, self.readline())
-            # Need to declare QUIT as global, since the method can change it
             # Read data from the socket and process it
             while True:
-                cmd = self.readline()
-                args = cmd.split(" ")
-                # Command `quit`
-                if args[0].lower() == "quit":
-                    if len(args) > 1:
-                        self.command_quit(message=' '.join(args[1:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: quit <message>"
-                        }))
-                # Command `nick`:
-                elif args[0].lower() == "nick":
-                    if len(args) > 1:
-                        self.command_nick(nick=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: nick <nick>"
-                        }))
-                # Command `userflag`
-                elif args[0].lower() == "userflag":
-                    if len(args) > 2:
-                        self.command_set_userflag(switch=args[1], flag=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "userflag <add/remove> <flag>"
-                        }))
-                # Command `chanlist`
-                elif args[0].lower() == "chanlist":
-                    self.command_channel_list()
-                # Command `register`
-                elif args[0].lower() == "register":
-                    if len(args) > 2:
-                        self.command_register(password=args[1], email=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: register <password> <email>"
-                        }))
-                # Command `login`
-                elif args[0].lower() == "login":
-                    if len(args) > 1:
-                        self.command_login(password=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: login <password>"
-                        }))
-                # Command `logout`
-                elif args[0].lower() == "logout":
-                    if self.logged_in():
-                        self.logout()
-                    else:
-                        client.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "You're not logged in."
-                        }))
-                # Command `usermsg`
-                elif args[0].lower() == "usermsg":
-                    if len(args) > 2:
-                        self.command_message_user(
-                            nick=args[1], message=' '.join(args[2:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: usermsg <nick> <message>"
-                        }))
-                # Command `whois`
-                elif args[0].lower() == "whois":
-                    if len(args) > 1:
-                        self.command_whois(nick=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: whois <nick>"
-                        }))
-                # Command `chanjoin`
-                elif args[0].lower() == "chanjoin":
-                    if len(args) == 2:
-                        self.command_channel_join(
-                            chan_name=args[1], password=None)
-                    elif len(args) == 3:
-                        self.command_channel_join(
-                            chan_name=args[1], password=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanjoin <channel> [password]"
-                        }))
-                # Command `chanpart`
-                elif args[0].lower() == "chanpart":
-                    if len(args) > 2:
-                        self.command_channel_part(
-                            chan_name=args[1], message=' '.join(args[2:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanpart <channel> <message>"
-                        }))
-                # Command `chanmsg`
-                elif args[0].lower() == "chanmsg":
-                    if len(args) > 2:
-                        self.command_channel_message(
-                            chan_name=args[1], message=' '.join(args[2:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanmsg <channel> <message>"
-                        }))
-                # Command `chankick`
-                elif args[0].lower() == "chankick":
-                    if len(args) > 3:
-                        self.command_channel_kick(
-                            chan_name=args[1], nick=args[2],
-                            message=' '.join(args[3:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chankick <channel> <nick> <reason>"
-                        }))
-                # Comamnd `chanflag`
-                elif args[0] == "chanflag":
-                    if len(args) > 4:
-                        self.command_channel_flag(chan_name=args[1], switch=args[2],
-                        flag=args[3], args=' '.join(args[4:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanflag <channel> <add/remove> <flag> <args>"
-                        }))
-                # Command `chanban`
-                elif args[0] == "chanban":
-                    if len(args) > 2:
-                        self.command_channel_ban(
-                            chan_name=args[1], nick=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanban <channel> <nick>"
-                        }))
-                # Command `chanunban`
-                elif args[0].lower() == "chanunban":
-                    if len(args) > 2:
-                        self.command_channel_unban(
-                            chan_name=args[1], ip=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanunban <channel> <IP>"
-                        }))
-                # Command `chanregister`
-                elif args[0].lower() == "chanregister":
-                    if len(args) > 1:
-                        self.command_channel_register(chan_name=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanregister <channel>"
-                        }))
-                # Command `chanbadword`
-                elif args[0].lower() == "chanbadword":
-                    if len(args) > 3:
-                        self.command_channel_badword(
-                            chan_name=args[1], switch=args[2],
-                            badword=args[3])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMGS",
-                            "message": "help: chanbadword <channel> <add/remove> <word>"
-                        }))
-                # Command  `chanclientflag`
-                elif args[0].lower() == "chanclientflag":
-                    if len(args) > 4:
-                        self.command_channel_clientflag(
-                            chan_name=args[1], switch=args[2],
-                            nick=args[3], flag=args[4])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanflag <channel> <add/remove> <nick> <flag>"
-                        }))
-                # Command `chanusers`
-                elif args[0].lower() == "chanusers":
-                    if len(args) > 1:
-                        self.command_channel_members(chan_name=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: chanusers <channel>"
-                        }))
-                # Command `oper`
-                elif args[0].lower() == "oper":
-                    if len(args) > 1:
-                        self.command_oper(password=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: oper <password>"
-                        }))
-                # Command `opermsg`
-                elif args[0].lower() == "opermsg":
-                    if len(args) > 1:
-                        self.command_oper_message(message=' '.join(args[1:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: opermsg <message>"
-                        }))
-                # Command `kill`
-                elif args[0].lower() == "kill":
-                    if len(args) > 1:
-                        self.command_oper_kill(args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: kill <nick>"
-                        }))
-                # Command `sanick`
-                elif args[0].lower() == "sanick":
-                    if len(args) > 2:
-                        self.command_oper_sanick(
-                            nick=args[1], new_nick=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: sanick <nick> <new nick>"
-                        }))
-                # Command `sajoin`
-                elif args[0].lower() == "sajoin":
-                    if len(args) > 2:
-                        self.command_oper_sajoin(
-                            nick=args[1], chan_name=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: sajoin <nick> <channel>"
-                        }))
-                # Command `sapart`
-                elif args[0].lower() == "sapart":
-                    if len(args) > 2:
-                        self.command_oper_sapart(
-                            nick=args[1], chan_name=args[2])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: sapart <nick> <channel>"
-                        }))
-                # Command `serverban`
-                elif args[0].lower() == "serverban":
-                    if len(args) > 1:
-                        self.command_oper_server_ban(ip=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: serverban <IP>"
-                        }))
-                # Command `globalmsg`
-                elif args[0].lower() == "globalmsg":
-                    if len(args) > 1:
-                        self.command_oper_global_message(
-                            message=' '.join(args[1:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: globalmsg <message>"
-                        }))
-                # Command `note`
-                elif args[0].lower() == "usernote":
-                    if len(args) > 2:
-                        self.command_usernote(nick=args[1],
-                            message=' '.join(args[2:]))
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: usernote <nick> <message>"
-                        }))
-                # Command `setpass`
-                elif args[0].lower() == "setpass":
-                    if len(args) > 1:
-                        self.command_set_pass(password=args[1])
-                    else:
-                        self.writeline(json.dumps({
-                            "type": "SERVERMSG",
-                            "message": "help: setpass <new password>"
-                        }))
-                else:
-                    self.writeline(json.dumps({
-                        "type": "INVALIDCOMMAND"
-                    }))
-            # Make sure the socket is closed once we're done with it
-            self.client.close()
-            return
+                line = self.readline()
+                if line is None or self.closed: # connection closed or killed
+                    self.quit("connection closed", "closed")
+                self.on_line(line)
         except Exception, err:
             print err
-            self.quit("client error")
+            self.quit("client error", "error")
             return
+        finally:
+            # Make sure a finished thread never stays registered
+            self.server.remove_client(self)
+
+    def on_line(self, line):
+        """
+        Handles one line sent by the client
+        The first valid line is used as the clients nick
+        every line after that is a command
+        """
+        self.lines_in += 1
+        if not self.picked_nick:
+            self.picked_nick = self.set_nick(self, line)
+        else:
+            self.handle_command(line)
+
+    def flooding(self, command):
+        """
+        Checks the rate limit of a command
+        Sends the client an error and returns True if they are over it
+        Opers are never limited
+        """
+        if not command.limit or self.is_oper():
+            return False
+        if self.limits.allow(self.server.CONFIG["RATE_LIMITS"], command.limit):
+            return False
+        self.writeline(json.dumps({
+            "type": "ERROR",
+            "code": errorcodes.get("rate limited"),
+            "message": "You're using %s too fast, slow down" % command.name
+        }))
+        return True
+
+    def handle_command(self, cmd):
+        """
+        Parses a command and runs it
+        """
+        COMMANDS.dispatch(self, cmd)
 
 # Commands
 
@@ -373,14 +159,14 @@ class Client(threading.Thread):
         allowed_flags = list("Bia")
         if switch == "add":
             if flag in allowed_flags and flag not in self.flags:
-                self.flags.append(flag)
+                self.flags.add(flag)
                 self.writeline(json.dumps({
                     "type": "SERVERMSG",
                     "message": "You set +%s on yourself" % flag
                 }))
         elif switch == "remove":
             if flag in self.flags:
-                self.flags.remove(flag)
+                self.flags.discard(flag)
                 self.writeline(json.dumps({
                     "type": "SERVERMSG",
                     "message": "You set -%s on yourself" % flag
@@ -392,14 +178,12 @@ class Client(threading.Thread):
         """
         account = self.server.get_account(nick)
         if account:
-            account.get("notes").append({
-                "from": self.nick,
-                "message": message
-            })
-            # Save changes
-            with open("accounts/%s.json" % nick, 'w') as f:
-                f.write(json.dumps(account,
-                sort_keys=True, indent=4, separators=(',', ': ')))
+            with self.server.accounts.lock:
+                account.get("notes").append({
+                    "from": self.nick,
+                    "message": message
+                })
+                self.server.accounts.save(nick, account)
             self.writeline(json.dumps({
                 "type": "SERVERMSG",
                 "message": "You sent a note to %s" % nick
@@ -431,6 +215,18 @@ class Client(threading.Thread):
                 "message": "You need to be logged in to change your password"
             }))
 
+    def command_logout(self):
+        """
+        Logs the client out of their account
+        """
+        if self.logged_in():
+            self.logout()
+        else:
+            self.writeline(json.dumps({
+                "type": "SERVERMSG",
+                "message": "You're not logged in."
+            }))
+
     def command_register(self, password, email):
         """
         Register an account with the server
@@ -611,7 +407,7 @@ class Client(threading.Thread):
             if switch.lower() == "add":
                 self.channels[chan_name].add_badword(self, badword)
             elif switch.lower() == "remove":
-                self.channels[chan_name].remove_badword(badword)
+                self.channels[chan_name].remove_badword(self, badword)
         else:
             self.writeline(json.dumps({
                 "type": "ERROR",
@@ -712,21 +508,114 @@ class Client(threading.Thread):
             }))
 
     def command_oper_rehash(self):
+        """
+        Reloads the server config and lists
+        """
         if self.is_oper():
             self.server.rehash()
+            self.writeline(json.dumps({
+                "type": "SERVERMSG",
+                "message": "Server rehashed"
+            }))
+            self.server.writeline("%s rehashed the server" % self.nick)
         else:
             self.writeline(json.dumps({
                 "type": "ERROR",
                 "code": errorcodes.get("not an oper"),
-                "message": "You need to be an oper to use the `announcement` command"
+                "message": "You need to be an oper to use the `rehash` command"
             }))
 
+    def command_oper_command_stats(self):
+        """
+        Sends how often each command ran and how long it took
+        histogram counts calls per latency bucket, `buckets` has the
+        upper bound of each bucket in seconds, the last one has no bound
+        """
+        self.writeline(json.dumps({
+            "type": "COMMANDSTATS",
+            "buckets": BUCKETS,
+            "commands": COMMANDS.stats()
+        }))
+
+    def command_oper_stats(self):
+        """
+        Sends live server stats, see Server.get_stats
+        """
+        stats = self.server.get_stats()
+        stats["type"] = "SERVERSTATS"
+        self.writeline(json.dumps(stats))
+
+    def command_oper_profile(self, action, rate=None):
+        """
+        Turns the sampling profiler on and off
+        action: start, stop, dump or status
+        rate: samples a second, defaults to PROFILE_RATE
+        dump writes collapsed stacks to PROFILE_PATH for flamegraphs
+        """
+        profiler = self.server.profiler
+        action = action.lower()
+        if action == "start":
+            try:
+                rate = float(rate or self.server.CONFIG["PROFILE_RATE"])
+            except ValueError:
+                rate = 0
+            if not 0 < rate <= 1000:
+                message = "The rate has to be between 0 and 1000 samples a second"
+            elif profiler.start(rate):
+                message = "Profiling at %g samples a second" % rate
+                self.server.writeline("%s started the profiler" % self.nick)
+            else:
+                message = "The profiler is already running"
+        elif action == "stop":
+            if profiler.stop():
+                message = "Profiler stopped after %(samples)i samples" % profiler.status()
+                self.server.writeline("%s stopped the profiler" % self.nick)
+            else:
+                message = "The profiler isn't running"
+        elif action == "dump":
+            name = profiler.dump(self.server.CONFIG["PROFILE_PATH"])
+            if name:
+                message = "Wrote %s" % name
+            else:
+                message = "Nothing to dump, use `profile start` first"
+        elif action == "status":
+            status = profiler.status()
+            status["type"] = "PROFILESTATUS"
+            self.writeline(json.dumps(status))
+            return
+        else:
+            message = "help: profile <start [rate]|stop|dump|status>"
+        self.writeline(json.dumps({
+            "type": "SERVERMSG",
+            "message": message
+        }))
+
+    def command_oper_memory(self, amount=20):
+        """
+        Sends what is using memory: the servers own objects and a
+        census of every live object by type, with the change since the
+        last memory command
+        amount: how many types to list
+        """
+        try:
+            amount = min(max(int(amount), 1), 200)
+        except ValueError:
+            amount = 20
+        self.writeline(json.dumps({
+            "type": "MEMORYSTATS",
+            "rss": metrics.rss(),
+            "server": self.server.get_memory(),
+            "gc": self.server.memory.report(amount)
+        }))
+
 
 # End Commands
 
     def set_nick(self, client, nick):
         """
         Sets the clients nick
+        Returns True if the nick was changed, otherwise the client
+        is told why and can send another nick
         """
         self.logout()
         if len(nick) <= self.server.CONFIG["MAX_NICK_LENGTH"]:
@@ -740,13 +629,11 @@ class Client(threading.Thread):
                                 self.server.CONFIG["NICK_CHAR_SET"]
                             )
                         }))
-                        self.set_nick(client, client.readline())
-                        return
-                if not self.server.find_nick(nick) and nick not in self.server.CONFIG["RESERVED_NICKS"]:
-                    old_nick = str(client.nick)
-                    client.nick = str(nick)
-                    del self.server.users[old_nick]
-                    self.server.users[client.nick] = self
+                        return False
+                old_nick = str(client.nick)
+                # rename_user refuses nicks in use, a case change is fine
+                if nick not in self.server.CONFIG["RESERVED_NICKS"] and \
+                        self.server.rename_user(client, str(nick)):
                     self.writeline(json.dumps({
                         "type": "NICK",
                         "old_nick": old_nick,
@@ -754,13 +641,14 @@ class Client(threading.Thread):
                     }))
                     self.server.writeline(
                         "%s is now known as %s" % (old_nick, nick))
+                    return True
                 else:
                     self.writeline(json.dumps({
                         "type": "ERROR",
                         "code": errorcodes.get("nick in use"),
                         "message": "%s is already in use. Please choose a new nick." % nick
                     }))
-                    self.set_nick(client, client.readline())
+                    return False
             else:
                 self.writeline(json.dumps({
                     "type": "ERROR",
@@ -768,7 +656,7 @@ class Client(threading.Thread):
                     "message": "Your nick is too short. Please choose a nick with more than %i chars" %
                     self.server.CONFIG["MIN_NICK_LENGTH"]
                 }))
-                self.set_nick(client, client.readline())
+                return False
         else:
             self.writeline(json.dumps({
                 "type": "ERROR",
@@ -776,7 +664,7 @@ class Client(threading.Thread):
                 "message": "Your nick is too long. Please choose a nick with more than %i chars" %
                 self.server.CONFIG["MAX_NICK_LENGTH"]
             }))
-            self.set_nick(client, client.readline())
+            return False
 
     def logged_in(self):
         return self.account
@@ -793,20 +681,150 @@ class Client(threading.Thread):
 
     def readline(self):
         """
-        Helper function, reads up to MAX_RECV_SIZE chars from the socket,
-        and returns them as a string, without any end of line markers
+        Helper function, reads from the socket until a full line is buffered
+        and returns it as a string, without any end of line markers
+        Returns None once the connection is closed
+        """
+        while True:
+            line = self.next_line()
+            if line is not None:
+                return line
+            if not self.fill():
+                return None
+
+    def fill(self):
+        """
+        Reads as much as fits into the receive buffer
+        Returns the amount of bytes read, 0 once the connection is closed
+        """
+        if self.inbuf is None:
+            self.inbuf, self.inview = self.server.take_buffer()
+        elif self.instart:
+            # Move the unfinished line to the front of the buffer
+            leftover = self.inend - self.instart
+            self.inbuf[:leftover] = self.inbuf[self.instart:self.inend]
+            self.instart, self.inend = 0, leftover
+        read = self.client.recv_into(self.inview[self.inend:])
+        self.inend += read
+        self.bytes_in += read
+        return read
+
+    def next_line(self):
+        """
+        Takes the next complete line out of the receive buffer
+        Returns None if there is no complete line buffered yet
+        Lines longer than MAX_LINE_LENGTH are dropped
+        """
+        if self.inbuf is None:
+            return None
+        max_length = self.server.CONFIG["MAX_LINE_LENGTH"]
+        while True:
+            end = self.inbuf.find('\n', self.instart, self.inend)
+            if end < 0:
+                if self.inend - self.instart > max_length:
+                    if not self.discarding:
+                        self.line_too_long()
+                        self.discarding = True
+                    self.instart = self.inend = 0
+                if not self.inend: # nothing buffered, hand the buffer back
+                    self.server.give_buffer(self.inbuf, self.inview)
+                    self.inbuf = self.inview = None
+                return None
+            start = self.instart
+            self.instart = end + 1
+            if self.instart == self.inend:
+                self.instart = self.inend = 0
+            if self.discarding: # end of a line that was too long
+                self.discarding = False
+            elif end - start > max_length:
+                self.line_too_long()
+            else:
+                return str(self.inbuf[start:end]).strip()
+
+    def line_too_long(self):
+        """
+        Tells the client a line it sent was dropped
         """
-        result = self.client.recv(self.server.CONFIG["MAX_RECV_SIZE"])
-        if(result != None):
-            result = result.strip()
-        return result
+        self.writeline(json.dumps({
+            "type": "ERROR",
+            "code": errorcodes.get("line too long"),
+            "message": "Lines can't be longer than %i chars" %
+            self.server.CONFIG["MAX_LINE_LENGTH"]
+        }))
 
     def writeline(self, message):
         """
         Helper function, writes the given string to the socket, with an end of
         line marker appended at the end
         """
-        self.client.send(message.strip() + '\n')
+        self.send_raw(message.strip() + '\n')
+
+    def send_raw(self, data):
+        """
+        Queues data for this client and sends as much of the queue as the
+        socket takes without blocking. The server writer sends the rest
+        once the socket is writable. If more than MAX_SEND_QUEUE bytes are
+        waiting the client is disconnected as a slow consumer
+        """
+        with self.out_lock:
+            if self.evicted:
+                return
+            self.outbox.append(data)
+            self.outbox_size += len(data)
+            self.lines_out += data.count('\n') # data can hold many lines
+            if self.flush() and not self.watched and self.server.writer:
+                self.watched = True
+                self.server.writer.watch(self)
+            slow = self.outbox_size > self.server.CONFIG["MAX_SEND_QUEUE"]
+        if slow:
+            self.evict("send queue exceeded %i bytes" %
+                       self.server.CONFIG["MAX_SEND_QUEUE"])
+
+    def flush(self):
+        """
+        Sends queued data until the queue is empty or the socket would
+        block. Must be called with out_lock held
+        Returns True if data is still waiting to be sent
+        """
+        while self.outbox:
+            data = self.outbox[0]
+            try:
+                sent = self.client.send(data, socket.MSG_DONTWAIT)
+            except socket.error, err:
+                if err.errno == errno.EINTR:
+                    continue
+                if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                # The connection is broken, the reader will notice
+                self.outbox.clear()
+                self.outbox_size = 0
+                return False
+            self.outbox_size -= sent
+            self.bytes_out += sent
+            if sent < len(data):
+                self.outbox[0] = buffer(data, sent)
+                return True
+            self.outbox.popleft()
+        return False
+
+    def evict(self, reason):
+        """
+        Drops a client that can't keep up with what is sent to it
+        Shutting down the socket wakes up the reader which then
+        runs quit
+        """
+        with self.out_lock:
+            if self.evicted:
+                return
+            self.evicted = True
+            self.outbox.clear()
+            self.outbox_size = 0
+        try:
+            self.client.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.server.writeline("%s (%s) was disconnected: %s" %
+                              (self.nick, self.ip, reason))
 
     def join(self, channel, key=None):
         """
@@ -867,8 +885,7 @@ class Client(threading.Thread):
         """
         Gives this client a flag
         """
-        if not flag in self.flags:
-            self.flags.append(flag)
+        self.flags.add(flag)
 
     def add_flags(self, flags):
         """
@@ -881,8 +898,7 @@ class Client(threading.Thread):
         """
         Removes a flag from this client
         """
-        if flag in self.flags:
-            self.flags.remove(flag)
+        self.flags.discard(flag)
 
     def remove_flags(self, flags):
         """
@@ -891,17 +907,29 @@ class Client(threading.Thread):
         for flag in flags:
             self.remove_flag(flag)
 
-    def quit(self, message):
+    def quit(self, message="bye bye", reason="quit"):
         """
         Disconnects the client from the server
-        """
-        for channel in self.channels:
-            self.channels[channel].on_quit(self, message)
-        if self in self.server.clients:
-            self.server.clients.remove(self)
-        del self.server.users[self.nick]
-        self.client.close()
-        quit()
+        Safe to call more than once
+        reason: why the client left, counted in Server.disconnects
+        """
+        if not self.closed:
+            self.closed = True
+            self.server.count_disconnect("evicted" if self.evicted else reason)
+            for channel in self.channels.values():
+                channel.on_quit(self, message)
+            self.channels = {}
+            self.server.remove_client(self)
+            if self.server.writer:
+                self.server.writer.unregister(self)
+            try: # wakes up the reader when quit runs on another thread
+                self.client.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.client.close()
+        # Only end the thread if it is this clients own thread
+        if self.thread is threading.current_thread():
+            quit()
 
     ##### Handlers #####
     def on_kill(self, message):
@@ -912,7 +940,7 @@ class Client(threading.Thread):
             "type": "YOUKILLED",
             "message": message
         }))
-        self.quit()
+        self.quit(reason="killed")
 
     def on_kick(self, channel, reason):
         """
@@ -1020,10 +1048,9 @@ class Client(threading.Thread):
                 "message": note.get("message")
             }))
         if self.account:
-            self.account["notes"] = []
-            with open("accounts/%s.json" % self.nick, 'w') as f:
-                f.write(json.dumps(self.account,
-                sort_keys=True, indent=4, separators=(',', ': ')))
+            with self.server.accounts.lock:
+                self.account["notes"] = []
+                self.server.accounts.save(self.nick, self.account)
 
     ##### Oper Commands #####
     def is_oper(self):
@@ -1035,7 +1062,7 @@ class Client(threading.Thread):
         Kinda like a channel kick but from the server
         """
         if self.is_oper():
-            if nick in self.server.users.keys():
+            if nick in self.server.users:
                 self.server.users[nick].on_kill("You were killed.")
                 self.writeline(json.dumps({
                     "type": "SERVERMSG",
@@ -1060,10 +1087,16 @@ class Client(threading.Thread):
         Force a user to change their nick
         """
         if self.is_oper():
-            if self.server.users.get(nick):
-                self.server.users[nick].nick = new_nick
-                self.server.users[nick].on_sanick(new_nick)
-                self.server.users[new_nick] = self.server.users[nick]
+            client = self.server.users.get(nick)
+            if client:
+                if not self.server.rename_user(client, new_nick):
+                    self.writeline(json.dumps({
+                        "type": "ERROR",
+                        "code": errorcodes.get("nick in use"),
+                        "message": "%s is already in use." % new_nick
+                    }))
+                    return
+                client.on_sanick(new_nick)
                 self.writeline(json.dumps({
                     "type": "SERVERMSG",
                     "message": "You changed %s nick to %s" % (nick, new_nick)
@@ -1153,7 +1186,7 @@ class Client(threading.Thread):
         Adds an ip to the banlist.txt
         """
         if self.is_oper():
-            self.server.ban_ip(self, ip)
+            self.server.ban_ip(ip)
             self.writeline(json.dumps({
                 "type": "SERVERMSG",
                 "message": "Banned %s from the server" % ip
@@ -1199,3 +1232,70 @@ class Client(threading.Thread):
                 "code": errorcodes.get("invalid channel/nick"),
                 "message": "No channel named %s" % channel
             }))
+
+
+# Every command a client can send, see commands.Command
+COMMANDS = CommandRegistry([
+    Command("quit", Client.command_quit, 1, rest=True,
+            usage="quit <message>"),
+    Command("nick", Client.command_nick, 1, usage="nick <nick>",
+            limit="nick"),
+    Command("userflag", Client.command_set_userflag, 2,
+            usage="userflag <add/remove> <flag>"),
+    Command("chanlist", Client.command_channel_list),
+    Command("register", Client.command_register, 2,
+            usage="register <password> <email>"),
+    Command("login", Client.command_login, 1, usage="login <password>"),
+    Command("logout", Client.command_logout),
+    Command("usermsg", Client.command_message_user, 2, rest=True,
+            usage="usermsg <nick> <message>", limit="message"),
+    Command("whois", Client.command_whois, 1, usage="whois <nick>",
+            limit="whois"),
+    Command("chanjoin", Client.command_channel_join, 1, optional=1,
+            usage="chanjoin <channel> [password]", limit="join"),
+    Command("chanpart", Client.command_channel_part, 2, rest=True,
+            usage="chanpart <channel> <message>"),
+    Command("chanmsg", Client.command_channel_message, 2, rest=True,
+            usage="chanmsg <channel> <message>", limit="message"),
+    Command("chankick", Client.command_channel_kick, 3, rest=True,
+            usage="chankick <channel> <nick> <reason>"),
+    Command("chanflag", Client.command_channel_flag, 4, rest=True,
+            usage="chanflag <channel> <add/remove> <flag> <args>"),
+    Command("chanban", Client.command_channel_ban, 2,
+            usage="chanban <channel> <nick>"),
+    Command("chanunban", Client.command_channel_unban, 2,
+            usage="chanunban <channel> <IP>"),
+    Command("chanregister", Client.command_channel_register, 1,
+            usage="chanregister <channel>"),
+    Command("chanbadword", Client.command_channel_badword, 3,
+            usage="chanbadword <channel> <add/remove> <word>"),
+    Command("chanclientflag", Client.command_channel_clientflag, 4,
+            usage="chanclientflag <channel> <add/remove> <nick> <flag>"),
+    Command("chanusers", Client.command_channel_members, 1,
+            usage="chanusers <channel>"),
+    Command("usernote", Client.command_usernote, 2, rest=True,
+            usage="usernote <nick> <message>", limit="message"),
+    Command("setpass", Client.command_set_pass, 1,
+            usage="setpass <new password>"),
+    Command("oper", Client.command_oper, 1, usage="oper <password>"),
+    Command("opermsg", Client.command_oper_message, 1, rest=True,
+            usage="opermsg <message>", oper=True),
+    Command("kill", Client.command_oper_kill, 1, usage="kill <nick>",
+            oper=True),
+    Command("sanick", Client.command_oper_sanick, 2,
+            usage="sanick <nick> <new nick>", oper=True),
+    Command("sajoin", Client.command_oper_sajoin, 2,
+            usage="sajoin <nick> <channel>", oper=True),
+    Command("sapart", Client.command_oper_sapart, 2,
+            usage="sapart <nick> <channel>", oper=True),
+    Command("serverban", Client.command_oper_server_ban, 1,
+            usage="serverban <IP>", oper=True),
+    Command("globalmsg", Client.command_oper_global_message, 1, rest=True,
+            usage="globalmsg <message>", oper=True),
+    Command("rehash", Client.command_oper_rehash, oper=True),
+    Command("cmdstats", Client.command_oper_command_stats, oper=True),
+    Command("stats", Client.command_oper_stats, oper=True),
+    Command("profile", Client.command_oper_profile, 1, optional=1,
+            usage="profile <start [rate]|stop|dump|status>", oper=True),
+    Command("memory", Client.command_oper_memory, optional=1, oper=True),
+])
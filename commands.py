@@ -0,0 +1,103 @@
+import time
+import json
+
+import errorcodes
+from metrics import Histogram
+
+
+class Command:
+    """
+    A command clients can send
+    handler: function(client, *args), usually a Client method
+    args: amount of args the command needs
+    optional: amount of extra args it can take
+    rest: the last arg is the rest of the line (messages, reasons)
+    usage: help text sent when args are missing
+    oper: only opers can use it
+    limit: RATE_LIMITS kind the command counts against
+    """
+    def __init__(self, name, handler, args=0, optional=0, rest=False,
+                 usage="", oper=False, limit=None):
+        self.name = name
+        self.handler = handler
+        self.args = args
+        self.optional = optional
+        self.rest = rest
+        self.usage = usage or name
+        self.oper = oper
+        self.limit = limit
+        self.stats = Histogram() # how often it ran and how long it took
+
+    def parse(self, words):
+        """
+        Turns the words after the command into handler args
+        Returns None if there aren't enough
+        """
+        if len(words) < self.args:
+            return None
+        if self.rest and self.args:
+            return words[:self.args - 1] + [' '.join(words[self.args - 1:])]
+        return words[:self.args + self.optional]
+
+
+class CommandRegistry:
+    """
+    Maps command names to commands, a dispatch is one dict lookup
+    """
+    def __init__(self, commands=()):
+        self.commands = {}
+        for command in commands:
+            self.add(command)
+
+    def add(self, command):
+        self.commands[command.name] = command
+
+    def get(self, name):
+        return self.commands.get(name.lower())
+
+    def dispatch(self, client, line):
+        """
+        Runs a line sent by `client`
+        """
+        words = line.split(" ")
+        command = self.get(words[0])
+        if command is None:
+            client.writeline(json.dumps({
+                "type": "INVALIDCOMMAND"
+            }))
+            return
+        args = command.parse(words[1:])
+        if args is None:
+            client.writeline(json.dumps({
+                "type": "SERVERMSG",
+                "message": "help: %s" % command.usage
+            }))
+            return
+        if command.oper and not client.is_oper():
+            client.writeline(json.dumps({
+                "type": "ERROR",
+                "code": errorcodes.get("not an oper"),
+                "message": "You need to be an oper to use the `%s` command" % command.name
+            }))
+            return
+        if command.limit and client.flooding(command):
+            return
+        start = time.time()
+        try:
+            command.handler(client, *args)
+        finally: # quit ends client threads with SystemExit
+            command.stats.record(time.time() - start)
+
+    def stats(self):
+        """
+        Returns the stats of every command that has run
+        """
+        return dict((name, command.stats.to_dict())
+                    for name, command in self.commands.items()
+                    if command.stats.calls)
+
+    def __iter__(self):
+        return iter(sorted(self.commands.values(), key=lambda c: c.name))
+
+    def __len__(self):
+        return len(self.commands)
@@ -7,6 +7,8 @@ codes = {
     "nick excecced limt": "006",
     "not an oper": "007",
     "not in channel": "008",
+    "line too long": "009",
+    "rate limited": "010",
 }
 
 def get(name):
@@ -0,0 +1,182 @@
+import select
+import socket
+import errno
+import threading
+
+
+class EventLoop:
+    """
+    Single threaded connection engine used when ENGINE is "event"
+    One epoll object watches the listening socket and every client
+    socket. Data sent by a client is handed to Client.on_line so the
+    server does not need a thread per connection.
+    """
+    def __init__(self, server):
+        self.server = server
+        self.poller = select.epoll()
+        self.clients = {} # fileno -> Client
+
+    def register(self, client):
+        """
+        Starts watching a clients socket
+        """
+        fd = client.client.fileno()
+        client.client.setblocking(0)
+        self.clients[fd] = client
+        self.poller.register(fd, select.EPOLLIN)
+
+    def unregister(self, client):
+        """
+        Stops watching a clients socket
+        Must be called before the socket is closed
+        """
+        try:
+            fd = client.client.fileno()
+        except socket.error: # socket is already closed
+            return
+        if self.clients.get(fd) is client:
+            del self.clients[fd]
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError):
+                pass
+
+    def watch(self, client):
+        """
+        Waits for a clients socket to become writable so its
+        outbox can be flushed
+        """
+        self.poller.modify(client.client.fileno(),
+                           select.EPOLLIN | select.EPOLLOUT)
+
+    def on_writable(self, client):
+        """
+        Flushes a clients outbox, stops waiting on the socket
+        once everything is sent
+        """
+        with client.out_lock:
+            if not client.flush():
+                client.watched = False
+                try:
+                    self.poller.modify(client.client.fileno(), select.EPOLLIN)
+                except (IOError, OSError, socket.error):
+                    pass
+
+    def drop(self, client, message, reason):
+        """
+        Disconnects a client after a read error
+        """
+        try:
+            client.quit(message, reason)
+        except Exception, err:
+            print("Client error: %s" % err)
+            self.unregister(client)
+
+    def on_readable(self, client):
+        """
+        Reads from a client and runs every line it sent
+        """
+        try:
+            read = client.fill()
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            read = 0
+        if not read: # connection closed
+            self.drop(client, "connection closed", "closed")
+            return
+        try:
+            # Run every complete line, a client can send many at once
+            while not client.closed:
+                line = client.next_line()
+                if line is None:
+                    break
+                client.on_line(line)
+        except Exception, err:
+            print(err)
+            self.drop(client, "client error", "error")
+
+    def run(self):
+        """
+        Waits for sockets to become ready and handles them
+        until the process is stopped
+        """
+        listen_fd = self.server.sock.fileno()
+        self.poller.register(listen_fd, select.EPOLLIN)
+        while True:
+            try:
+                events = self.poller.poll()
+            except IOError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == listen_fd:
+                    self.server.accept_clients()
+                    continue
+                client = self.clients.get(fd)
+                if client and event & select.EPOLLOUT:
+                    self.on_writable(client)
+                if client and event & ~select.EPOLLOUT:
+                    self.on_readable(client)
+
+
+class OutboundWriter(threading.Thread):
+    """
+    Sends queued data for the thread engine
+    Client threads only block on reading, anything a socket can't
+    take right away is sent from here once the socket is writable
+    """
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.server = server
+        self.poller = select.epoll()
+        self.clients = {} # fileno -> Client
+
+    def watch(self, client):
+        """
+        Waits for a clients socket to become writable
+        """
+        fd = client.client.fileno()
+        self.clients[fd] = client
+        self.poller.register(fd, select.EPOLLOUT)
+
+    def unregister(self, client):
+        """
+        Stops watching a clients socket
+        Must be called before the socket is closed
+        """
+        try:
+            fd = client.client.fileno()
+        except socket.error: # socket is already closed
+            return
+        if self.clients.get(fd) is client:
+            del self.clients[fd]
+            try:
+                self.poller.unregister(fd)
+            except (IOError, OSError):
+                pass
+
+    def on_writable(self, client):
+        """
+        Flushes a clients outbox, stops watching the socket
+        once everything is sent
+        """
+        with client.out_lock:
+            if not client.flush():
+                client.watched = False
+                self.unregister(client)
+
+    def run(self):
+        while True:
+            try:
+                events = self.poller.poll()
+            except IOError, err:
+                if err.errno == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                client = self.clients.get(fd)
+                if client:
+                    self.on_writable(client)
@@ -0,0 +1,52 @@
+import string
+
+LETTERS = string.ascii_letters
+BITS = dict((letter, 1 << i) for i, letter in enumerate(LETTERS))
+
+
+def valid(flag):
+    """
+    Flags are one letter, a-z or A-Z
+    """
+    return flag in BITS
+
+
+class FlagSet(object):
+    """
+    Set of one letter flags stored as the bits of an int
+    Takes the room of one small int instead of a list of strings
+    Iterates in a-z then A-Z order
+    """
+    __slots__ = ("bits",)
+
+    def __init__(self, flags=()):
+        self.bits = 0
+        for flag in flags:
+            self.add(flag)
+
+    def add(self, flag):
+        """
+        Adds a flag, anything that isn't a flag is ignored
+        """
+        self.bits |= BITS.get(flag, 0)
+
+    def discard(self, flag):
+        self.bits &= ~BITS.get(flag, 0)
+
+    def __contains__(self, flag):
+        return bool(self.bits & BITS.get(flag, 0))
+
+    def __iter__(self):
+        bits = self.bits
+        for letter in LETTERS:
+            if bits & BITS[letter]:
+                yield letter
+
+    def __len__(self):
+        return bin(self.bits).count("1")
+
+    def __nonzero__(self):
+        return self.bits != 0
+
+    def __str__(self):
+        return "".join(self)
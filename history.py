@@ -0,0 +1,113 @@
+import os
+import mmap
+import struct
+import urllib
+import threading
+
+OFFSET = struct.Struct("<Q") # one index entry, where a line starts in the log
+
+
+class HistoryLog:
+    """
+    Append only log of the encoded messages sent to a channel
+    <name>.log holds the lines exactly as they were sent and <name>.idx
+    holds the offset each line starts at, so the last N lines are found
+    with one index read and sent straight from the mapped log
+    """
+    def __init__(self, path, name):
+        if not os.path.exists(path):
+            os.mkdir(path, 0777)
+        base = os.path.join(path, urllib.quote(name, safe="#&"))
+        self.lock = threading.Lock()
+        self.log = open(base + ".log", 'a+b')
+        self.idx = open(base + ".idx", 'a+b')
+        self.size = os.fstat(self.log.fileno()).st_size
+        self.count = os.fstat(self.idx.fileno()).st_size // OFFSET.size
+        self.map = None
+        if not self.valid():
+            self.reindex()
+
+    def offset(self, line):
+        """
+        Returns where line number `line` starts in the log
+        """
+        self.idx.seek(line * OFFSET.size)
+        return OFFSET.unpack(self.idx.read(OFFSET.size))[0]
+
+    def mapped(self):
+        """
+        Returns the log mapped into memory, mapped again if it grew
+        Old maps stay alive as long as a client still has data from them
+        """
+        if self.map is None or len(self.map) < self.size:
+            self.map = mmap.mmap(self.log.fileno(), self.size,
+                                 access=mmap.ACCESS_READ)
+        return self.map
+
+    def valid(self):
+        """
+        Checks that the index matches the log
+        They can be out of sync if the server died while writing
+        """
+        if os.fstat(self.idx.fileno()).st_size % OFFSET.size:
+            return False
+        if not self.count:
+            return self.size == 0
+        last = self.offset(self.count - 1)
+        if last >= self.size:
+            return False
+        return self.mapped().find('\n', last) == self.size - 1
+
+    def reindex(self):
+        """
+        Rebuilds the index from the log
+        A half written line at the end of the log is dropped
+        """
+        offsets = []
+        start = 0
+        if self.size:
+            log = self.mapped()
+            end = log.find('\n')
+            while end != -1:
+                offsets.append(start)
+                start = end + 1
+                end = log.find('\n', start)
+        self.map = None
+        if start != self.size:
+            self.log.truncate(start)
+            self.size = start
+        self.idx.truncate(0)
+        self.idx.write(''.join(OFFSET.pack(offset) for offset in offsets))
+        self.idx.flush()
+        self.count = len(offsets)
+
+    def append(self, data):
+        """
+        Adds an encoded line to the log, `data` must end with a newline
+        """
+        with self.lock:
+            self.log.seek(0, os.SEEK_END)
+            self.log.write(data)
+            self.log.flush()
+            self.idx.seek(0, os.SEEK_END)
+            self.idx.write(OFFSET.pack(self.size))
+            self.idx.flush()
+            self.size += len(data)
+            self.count += 1
+
+    def tail(self, amount):
+        """
+        Returns the last `amount` lines as a buffer over the mapped log
+        Nothing is copied or decoded
+        """
+        with self.lock:
+            amount = min(amount, self.count)
+            if not amount:
+                return ''
+            start = self.offset(self.count - amount)
+            return buffer(self.mapped(), start, self.size - start)
+
+    def close(self):
+        with self.lock:
+            self.log.close()
+            self.idx.close()
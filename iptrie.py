@@ -0,0 +1,129 @@
+import socket
+import struct
+
+BITS = {socket.AF_INET: 32, socket.AF_INET6: 128}
+
+
+def parse_ip(ip):
+    """
+    Turns an IPv4 or IPv6 address into (family, int)
+    IPv4 mapped IPv6 addresses are treated as IPv4
+    Returns None if `ip` isn't an address
+    """
+    try:
+        packed = socket.inet_pton(socket.AF_INET, ip)
+        return socket.AF_INET, struct.unpack("!I", packed)[0]
+    except (socket.error, TypeError, UnicodeError):
+        pass
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (socket.error, TypeError, UnicodeError):
+        return None
+    high, low = struct.unpack("!QQ", packed)
+    if high == 0 and low >> 32 == 0xffff: # ::ffff:a.b.c.d
+        return socket.AF_INET, low & 0xffffffff
+    return socket.AF_INET6, (high << 64) | low
+
+
+def parse_mask(mask):
+    """
+    Turns an IP, CIDR range or wildcard mask into (family, int, prefix)
+    e.g. 10.0.0.1, 10.0.0.0/16, 10.0.*.*, 2001:db8::/32
+    Returns None if `mask` isn't one of those
+    """
+    mask = mask.strip()
+    if '*' in mask: # only trailing IPv4 octets can be wildcards
+        octets = mask.split('.')
+        fixed = [o for o in octets if o != '*']
+        if len(octets) > 4 or octets[:len(fixed)] != fixed:
+            return None
+        fixed += ['0'] * (4 - len(fixed))
+        parsed = parse_ip('.'.join(fixed))
+        if not parsed or parsed[0] != socket.AF_INET:
+            return None
+        return parsed[0], parsed[1], 8 * (len(octets) - octets.count('*'))
+    if '/' in mask:
+        address, prefix = mask.split('/', 1)
+        if not prefix.isdigit():
+            return None
+        parsed = parse_ip(address)
+        if not parsed:
+            return None
+        prefix = int(prefix)
+        if ':' in address and parsed[0] == socket.AF_INET:
+            prefix -= 96 # ::ffff:0:0/96 mapped range
+        if not 0 <= prefix <= BITS[parsed[0]]:
+            return None
+        return parsed[0], parsed[1], prefix
+    parsed = parse_ip(mask)
+    if not parsed:
+        return None
+    return parsed[0], parsed[1], BITS[parsed[0]]
+
+
+class IPTrie(object):
+    """
+    Set of IPs and networks stored in a binary prefix trie
+    Checking an address walks at most one node per address bit
+    no matter how many entries there are
+    Entries that aren't addresses (e.g. oper vhosts) are matched exactly
+    Nodes and the set of exact entries are only made once something
+    is added to them
+    """
+    __slots__ = ("roots", "other", "size")
+
+    def __init__(self, masks=()):
+        # node = [zero child, one child, True if a network ends here]
+        self.roots = {} # family -> root node
+        self.other = None # set of exact entries
+        self.size = 0
+        for mask in masks:
+            self.add(mask)
+
+    def add(self, mask):
+        """
+        Adds an IP, CIDR range or wildcard mask
+        """
+        parsed = parse_mask(mask)
+        if not parsed:
+            if self.other is None:
+                self.other = set()
+            self.other.add(mask.strip())
+            return
+        family, address, prefix = parsed
+        bits = BITS[family]
+        node = self.roots.get(family)
+        if node is None:
+            node = self.roots[family] = [None, None, False]
+        for i in xrange(prefix):
+            if node[2]: # a wider network already covers this one
+                return
+            bit = (address >> (bits - 1 - i)) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, False]
+            node = node[bit]
+        if not node[2]:
+            node[2] = True
+            self.size += 1
+
+    def __contains__(self, ip):
+        if not self.size and self.other is None: # empty, skip parsing
+            return False
+        parsed = parse_ip(ip)
+        if not parsed:
+            return self.other is not None and ip in self.other
+        family, address = parsed
+        bits = BITS[family]
+        node = self.roots.get(family)
+        if node is None:
+            return False
+        for i in xrange(bits):
+            if node[2]:
+                return True
+            node = node[(address >> (bits - 1 - i)) & 1]
+            if node is None:
+                return False
+        return node[2]
+
+    def __len__(self):
+        return self.size + len(self.other or ())
@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+
+from iptrie import IPTrie
+
+
+class ListFile:
+    """
+    A text file with one entry per line, kept in memory as a set
+    The file is read again when it changes on disk, that is checked
+    at most once every `interval` seconds
+    """
+    def __init__(self, path, interval=5):
+        self.path = path
+        self.interval = interval
+        self.entries = set()
+        self.mtime = None
+        self.checked = 0
+        self.lock = threading.Lock()
+        self.reload()
+
+    def parse(self, line):
+        """
+        Turns a line of the file into an entry
+        """
+        return line.strip()
+
+    def container(self):
+        """
+        Returns an empty container for the entries
+        """
+        return set()
+
+    def reload(self):
+        """
+        Reads the whole file into memory
+        """
+        entries = self.container()
+        mtime = None
+        if os.path.exists(self.path):
+            mtime = os.path.getmtime(self.path)
+            with open(self.path, 'r') as f:
+                for line in f:
+                    if line.strip():
+                        entries.add(self.parse(line))
+        self.entries = entries
+        self.mtime = mtime
+        self.checked = time.time()
+
+    def check(self):
+        """
+        Reloads the file if it changed since it was last read
+        """
+        now = time.time()
+        if now - self.checked < self.interval:
+            return
+        self.checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError: # the file was removed
+            mtime = None
+        if mtime != self.mtime:
+            self.reload()
+
+    def add(self, entry):
+        """
+        Adds an entry to the file and to memory
+        """
+        with self.lock:
+            with open(self.path, 'a') as f:
+                f.write(entry + "\n")
+            self.entries.add(self.parse(entry))
+            self.mtime = os.path.getmtime(self.path)
+
+    def __contains__(self, entry):
+        self.check()
+        return entry in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class IPListFile(ListFile):
+    """
+    List of IPs, CIDR ranges (10.0.0.0/8) and wildcard masks (10.0.*.*)
+    """
+    def container(self):
+        return IPTrie()
+
+
+class ILineFile(IPListFile):
+    """
+    I:Lines file, anything after the IP on a line is a comment
+    """
+    def parse(self, line):
+        return line.split()[0]
@@ -0,0 +1,104 @@
+import gc
+import sys
+import time
+import threading
+
+
+def type_name(obj):
+    cls = getattr(obj, "__class__", type(obj)) # old style instances too
+    module = getattr(cls, "__module__", None)
+    if module in (None, "__builtin__"):
+        return cls.__name__
+    return "%s.%s" % (module, cls.__name__)
+
+
+def size_of(obj):
+    """
+    Approximate size of an object: the object, its __slots__ and
+    __dict__ and the values in them, one level deep. Shared values
+    are counted every time
+    """
+    size = sys.getsizeof(obj)
+    for cls in type(obj).__mro__:
+        slots = cls.__dict__.get("__slots__", ())
+        if isinstance(slots, basestring):
+            slots = (slots,)
+        for slot in slots:
+            if slot in ("__dict__", "__weakref__"):
+                continue
+            try:
+                size += sys.getsizeof(getattr(obj, slot))
+            except AttributeError: # slot not set
+                pass
+    attrs = getattr(obj, "__dict__", None)
+    if attrs is not None:
+        size += sys.getsizeof(attrs)
+        for value in attrs.itervalues():
+            size += sys.getsizeof(value)
+    return size
+
+
+def census():
+    """
+    Counts the objects the garbage collector tracks by type
+    Returns {type: [count, bytes]} with shallow sizes. Strings and
+    numbers aren't tracked, they only add to what holds them
+    """
+    types = {}
+    for obj in gc.get_objects():
+        name = type_name(obj)
+        try:
+            size = sys.getsizeof(obj)
+        except TypeError:
+            size = 0
+        entry = types.get(name)
+        if entry is None:
+            types[name] = [1, size]
+        else:
+            entry[0] += 1
+            entry[1] += size
+    return types
+
+
+class MemoryTracker:
+    """
+    Takes a census of live objects and diffs it against the last one
+    A census walks every object, the server stops while it runs
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.last = None
+        self.last_time = None
+
+    def report(self, top=20):
+        """
+        Returns the `top` types by size and the `top` changes since
+        the last report
+        """
+        with self.lock:
+            types = census()
+            now = time.time()
+            diff = None
+            if self.last is not None:
+                changes = []
+                for name in set(types) | set(self.last):
+                    count, size = types.get(name, (0, 0))
+                    old_count, old_size = self.last.get(name, (0, 0))
+                    if count != old_count or size != old_size:
+                        changes.append((name, count - old_count, size - old_size))
+                changes.sort(key=lambda change: abs(change[2]), reverse=True)
+                diff = {
+                    "seconds": now - self.last_time,
+                    "types": [{"type": name, "count": count, "bytes": size}
+                              for name, count, size in changes[:top]]
+                }
+            self.last = types
+            self.last_time = now
+        largest = sorted(types.items(), key=lambda item: item[1][1], reverse=True)
+        return {
+            "objects": sum(count for count, size in types.itervalues()),
+            "bytes": sum(size for count, size in types.itervalues()),
+            "types": [{"type": name, "count": count, "bytes": size}
+                      for name, (count, size) in largest[:top]],
+            "diff": diff
+        }
@@ -0,0 +1,184 @@
+import os
+import time
+import bisect
+import resource
+import threading
+import BaseHTTPServer
+
+from collections import deque
+
+# Upper bounds (in seconds) of latency histogram buckets
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+           0.05, 0.1, 0.25, 0.5, 1.0)
+# Traffic counters every Client keeps
+TRAFFIC = ("lines_in", "bytes_in", "lines_out", "bytes_out")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def traffic(client):
+    """
+    Returns the traffic counters of a client as a list
+    """
+    return [client.lines_in, client.bytes_in,
+            client.lines_out, client.bytes_out]
+
+
+def rss():
+    """
+    Returns the resident memory of this process in bytes
+    Falls back to the peak if /proc isn't there
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Histogram:
+    """
+    Counts how long something took, per latency bucket
+    """
+    def __init__(self, buckets=BUCKETS):
+        self.bounds = buckets
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(buckets) + 1) # the last one is +Inf
+
+    def record(self, seconds):
+        bucket = bisect.bisect_left(self.bounds, seconds)
+        with self.lock:
+            self.calls += 1
+            self.seconds += seconds
+            self.buckets[bucket] += 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "seconds": self.seconds,
+                "avg_ms": self.seconds / self.calls * 1000 if self.calls else 0,
+                "histogram": self.buckets[:]
+            }
+
+
+class RateTracker:
+    """
+    Turns ever growing counters into per second rates
+    Rates are averaged over the last `window` seconds of samples
+    """
+    def __init__(self, window=10):
+        self.window = window
+        self.samples = deque([(time.time(), None)])
+
+    def update(self, counters):
+        """
+        Adds a sample of {name: total} and returns {name: per second}
+        """
+        now = time.time()
+        while len(self.samples) > 1 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+        then, old = self.samples[0]
+        self.samples.append((now, counters))
+        elapsed = now - then
+        rates = {}
+        for name, total in counters.items():
+            start = old.get(name, 0) if old else 0
+            rates[name] = (total - start) / elapsed if elapsed > 0 else 0.0
+        return rates
+
+
+def escape(value):
+    """
+    Escapes a label value for the Prometheus text format
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Exposition:
+    """
+    Builds a page of metrics in the Prometheus text format
+    """
+    def __init__(self):
+        self.lines = []
+
+    def header(self, name, kind, help):
+        self.lines.append("# HELP %s %s" % (name, help))
+        self.lines.append("# TYPE %s %s" % (name, kind))
+
+    def sample(self, name, labels, value):
+        if labels:
+            name += "{%s}" % ",".join('%s="%s"' % (label, escape(labels[label]))
+                                      for label in sorted(labels))
+        self.lines.append("%s %s" % (name, format_value(value)))
+
+    def add(self, name, kind, help, samples):
+        """
+        samples: a number or a list of ({label: value}, number)
+        """
+        self.header(name, kind, help)
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.sample(name, labels, value)
+
+    def histogram(self, name, help, series):
+        """
+        series: a list of ({label: value}, Histogram)
+        """
+        self.header(name, "histogram", help)
+        for labels, histogram in series:
+            stats = histogram.to_dict()
+            total = 0
+            bounds = map(format_value, histogram.bounds) + ["+Inf"]
+            for bound, count in zip(bounds, stats["histogram"]):
+                total += count # buckets are cumulative
+                self.sample(name + "_bucket", dict(labels, le=bound), total)
+            self.sample(name + "_sum", labels, stats["seconds"])
+            self.sample(name + "_count", labels, stats["calls"])
+
+    def text(self):
+        return "\n".join(self.lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves GET /metrics
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # don't print a line for every scrape
+
+
+class MetricsServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP listener for metrics scrapers, runs in its own thread
+    render: function that returns the metrics page
+    """
+    def __init__(self, address, render):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.render = render
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
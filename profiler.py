@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import thread
+import threading
+
+from collections import Counter
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler:
+    """
+    Wall clock profiler for the whole process
+    A thread looks at the stack of every other thread `rate` times a
+    second, nothing is traced so the server runs at full speed between
+    samples. Stacks are kept collapsed ("outer;...;inner" -> samples),
+    the format flamegraph.pl and speedscope read
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stacks = Counter()
+        self.samples = 0
+        self.rate = 0
+        self.thread = None
+        self.started = None
+        self.stopped = None
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self, rate=100):
+        """
+        Starts sampling, forgets the samples of the last run
+        Returns False if it is already running
+        """
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.rate = rate
+            self.started = time.time()
+            self.stopped = None
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stops sampling, the samples are kept until the next start
+        Returns False if it wasn't running
+        """
+        with self.lock:
+            if not self.running:
+                return False
+            self.thread = None
+            self.stopped = time.time()
+        return True
+
+    def run(self):
+        me = threading.current_thread()
+        ident = thread.get_ident()
+        interval = 1.0 / self.rate
+        while self.thread is me:
+            frames = sys._current_frames()
+            stacks = []
+            for thread_id, frame in frames.items():
+                if thread_id == ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_name(frame))
+                    frame = frame.f_back
+                stack.reverse()
+                stacks.append(";".join(stack))
+            frames = frame = None # don't keep frames alive between samples
+            with self.lock:
+                if self.thread is not me:
+                    break
+                self.stacks.update(stacks)
+                self.samples += 1
+            time.sleep(interval)
+
+    def status(self):
+        with self.lock:
+            return {
+                "running": self.running,
+                "rate": self.rate,
+                "samples": self.samples,
+                "stacks": len(self.stacks),
+                "seconds": ((self.stopped or time.time()) - self.started
+                            if self.started else 0)
+            }
+
+    def dump(self, path):
+        """
+        Writes the collapsed stacks to a new file in `path`
+        Returns the file name, None if there is nothing to write
+        """
+        with self.lock:
+            stacks = self.stacks.most_common()
+        if not stacks:
+            return None
+        if not os.path.exists(path):
+            os.mkdir(path, 0777)
+        name = os.path.join(path, "awwrc-%s-%d.folded" % (
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid()))
+        with open(name, 'w') as f:
+            for stack, samples in stacks:
+                f.write("%s %d\n" % (stack, samples))
+        return name
@@ -0,0 +1,105 @@
+import time
+
+from collections import deque
+
+
+class TokenBucket(object):
+    """
+    Allows `rate` actions a second on average with bursts of up to `burst`
+    """
+    __slots__ = ("limit", "rate", "burst", "tokens", "last")
+
+    def __init__(self, rate, burst):
+        self.limit = [rate, burst]
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.last = time.time()
+
+    def take(self, amount=1):
+        """
+        Takes `amount` tokens, returns False if there aren't enough
+        """
+        now = time.time()
+        if now > self.last:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        amount = min(amount, self.burst) # big actions still go through
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+
+class RateLimiter(object):
+    """
+    One token bucket for every kind of action
+    Limits come from a {kind: [rate, burst]} dict, usually the
+    RATE_LIMITS config, kinds without a limit are never limited
+    Clients have one for their commands and channel output, channels
+    one for their total output. Buckets are only made once something
+    is limited
+    """
+    __slots__ = ("buckets",)
+
+    def __init__(self):
+        self.buckets = None
+
+    def allow(self, limits, kind, amount=1):
+        """
+        Returns True if the action can go ahead
+        """
+        limit = limits.get(kind)
+        if not limit:
+            return True
+        if self.buckets is None:
+            self.buckets = {}
+        bucket = self.buckets.get(kind)
+        if bucket is None or bucket.limit != limit: # new or rehashed
+            bucket = self.buckets[kind] = TokenBucket(*limit)
+        return bucket.take(amount)
+
+
+class ConnectLimiter:
+    """
+    Sliding window limits on new connections, per IP and for the
+    whole server. A limit is [connections, seconds]
+    """
+    def __init__(self):
+        self.recent = deque() # times of recent connections
+        self.by_ip = {} # ip -> deque of connection times
+        self.pruned = time.time()
+
+    def allow(self, window, limit, now):
+        """
+        Returns True and records the connection if `window` has room
+        """
+        while window and window[0] <= now - limit[1]:
+            window.popleft()
+        if len(window) >= limit[0]:
+            return False
+        window.append(now)
+        return True
+
+    def allow_ip(self, ip, limit):
+        """
+        Checks and records a connection from `ip`
+        """
+        if not limit:
+            return True
+        now = time.time()
+        if now - self.pruned > limit[1]: # forget IPs that went quiet
+            self.pruned = now
+            for old in [old for old, window in self.by_ip.items()
+                        if not window or window[-1] <= now - limit[1]]:
+                del self.by_ip[old]
+        return self.allow(self.by_ip.setdefault(ip, deque()), limit, now)
+
+    def allow_total(self, limit):
+        """
+        Checks and records a connection to the server
+        """
+        if not limit:
+            return True
+        return self.allow(self.recent, limit, time.time())
@@ -0,0 +1,19 @@
+import sys
+import json
+
+sys.path.insert(0, "..")
+import storage
+
+# Copies accounts/ and channels/ into the sqlite database
+# Example: python import_json.py [database]
+config = json.load(open("../config.json"))
+path = sys.argv[1] if len(sys.argv) > 1 else config.get("STORAGE_PATH", "awwrc.db")
+source = storage.open_backend("json", root="../")
+db = storage.open_backend("sqlite", path, root="../")
+accounts = list(source.accounts())
+db.put_accounts(accounts)
+channels = list(source.channels())
+db.put_channels(channels)
+db.close()
+print("Imported %d accounts and %d channels into %s" % (len(accounts), len(channels), path))
+print('Set "STORAGE": "sqlite" in config.json to use it')
@@ -1,9 +1,16 @@
+import sys
 import json
-import glob
 
-for f in glob.glob("../accounts/*.json"):
-    account = json.load(open(f))
+sys.path.insert(0, "..")
+import storage
+
+config = json.load(open("../config.json"))
+backend = storage.open_backend(config.get("STORAGE", "json"),
+    config.get("STORAGE_PATH", "awwrc.db"), root="../")
+changed = []
+for nick, account in backend.accounts():
     if not account.get("notes"):
         account["notes"] = []
-    with open(f, 'w') as nf:
-        nf.write(json.dumps(account, sort_keys=True, indent=4, separators=(',', ': ')))
+        changed.append((nick, account))
+backend.put_accounts(changed)
+backend.close()
@@ -1,9 +1,16 @@
+import sys
 import json
-import glob
 
-for f in glob.glob("../channels/*.json"):
-    account = json.load(open(f))
-    if not account.get("public_notes"):
-        account["public_notes"] = []
-    with open(f, 'w') as nf:
-        nf.write(json.dumps(account, sort_keys=True, indent=4, separators=(',', ': ')))
+sys.path.insert(0, "..")
+import storage
+
+config = json.load(open("../config.json"))
+backend = storage.open_backend(config.get("STORAGE", "json"),
+    config.get("STORAGE_PATH", "awwrc.db"), root="../")
+changed = []
+for name, channel in backend.channels():
+    if not channel.get("public_notes"):
+        channel["public_notes"] = []
+        changed.append((name, channel))
+backend.put_channels(changed)
+backend.close()
@@ -1,17 +1,55 @@
 import sys
 import socket
+import select
+import errno
 import threading
 import time
 import json
-import glob
 import os
 import uuid
 
+from collections import Counter
+
 # Local Imports
-from client import Client
+from client import Client, COMMANDS
+from accounts import AccountStore
+import storage
 from channel import Channel
+from eventloop import EventLoop, OutboundWriter
+from listfile import ListFile, IPListFile, ILineFile
+from ratelimit import ConnectLimiter
+import metrics
+import memory
+from profiler import SamplingProfiler
 import errorcodes
 
+# Sent to connections that are turned away, encoded once
+SERVER_FULL = json.dumps({"type": "SERVERFULL"}) + '\n'
+SERVER_BANNED = json.dumps({"type": "YOUSERVERBANNED"}) + '\n'
+TOO_MANY_CONNECTIONS = json.dumps({
+    "type": "SERVERMSG",
+    "message": "Too many connections from this IP"
+}) + '\n'
+CONNECTING_TOO_FAST = json.dumps({
+    "type": "SERVERMSG",
+    "message": "Connecting too fast, try again later"
+}) + '\n'
+# Ends the greeting, asks the client to pick a nick
+PICK_NICK = json.dumps({"type": "PICKNICK"}) + '\n'
+
+# Config keys clients are told about in SERVERCONFIG, the rest
+# (addresses, paths, ports, tuning) stays on the server
+PUBLIC_CONFIG = (
+    "CHAN_BADWORD_LIMIT", "CHAN_BAN_LIMIT", "CHAN_HISTORY",
+    "CHAN_PLAYBACK_LIMIT", "CHAN_TOPIC_LIMIT", "CHANNEL_CREATION",
+    "CONNECTION_LIMIT", "DEFAULT_CHAN_FLAGS", "DEFAULT_CLIENT_FLAGS",
+    "MAX_CHAN_NAME_LENGTH", "MAX_LINE_LENGTH", "MAX_NICK_LENGTH",
+    "MIN_NICK_LENGTH", "NICK_CHAR_SET", "RATE_LIMITS", "RESERVED_NICKS",
+    "SERVER_ADMIN_CHANNEL", "SERVER_MAX_USERS"
+)
+# Most spare receive buffers kept for reuse, see Server.take_buffer
+RECV_BUFFER_POOL = 64
+
 
 class Server:
 
@@ -24,25 +62,63 @@ class Server:
     def __init__(self):
         self.CONFIG = self.load_config()
         self.sock = None
-        self.clients = []
+        self.loop = None
+        self.writer = None
+        self.clients = set()
         self.users = {}
+        self.nicks = {} # lowercase nick -> nick
+        # Guards clients, users and nicks, client threads change them
+        self.lock = threading.RLock()
         self.opers = []
-        self.ips = []
+        self.ips = Counter() # ip -> connected clients
+        self.connects = ConnectLimiter()
+        self.recv_buffers = [] # spare (bytearray, memoryview) pairs
+        self.started = time.time()
+        self.traffic = [0] * len(metrics.TRAFFIC) # from clients that left
+        self.accepted = 0
+        self.rejected = 0
+        self.rates = metrics.RateTracker()
+        self.disconnects = Counter() # reason -> clients
+        self.fanout = metrics.Histogram() # time taken by channel broadcasts
+        self.metrics = None
+        self.profiler = SamplingProfiler()
+        self.memory = memory.MemoryTracker()
+        self.load_lists()
+        self.build_greeting()
+        self.storage = storage.open_backend(self.CONFIG["STORAGE"],
+            self.CONFIG["STORAGE_PATH"])
+        self.accounts = AccountStore(self.storage,
+            self.CONFIG["ACCOUNT_CACHE_SIZE"], self.CONFIG["ACCOUNT_FLUSH_INTERVAL"])
         self.channels = self.load_channels()
         print(self.CONFIG)
         self.channels[self.CONFIG["SERVER_ADMIN_CHANNEL"]] = Channel(self,
             self.CONFIG["SERVER_ADMIN_CHANNEL"], {"O": True, "p": True}, "Server Admin Channel")
-        if not os.path.exists("accounts/"):
-            os.mkdir("accounts/", mode=0777)
-        if not os.path.exists("channels/"):
-            os.mkdir("channels/", mode=0777)
 
     def rehash(self):
         """
-        Reloads the config and channels
+        Reloads the config, the ban, I:line and oper lists and
+        loads channels that were added to the channels folder
+        Channels that are already loaded keep their members
         """
-        self.channels = self.load_channels()
         self.CONFIG = self.load_config()
+        self.load_lists()
+        self.build_greeting()
+        for name, channel in self.load_channels().items():
+            if name not in self.channels:
+                self.channels[name] = channel
+        for channel in self.channels.values():
+            channel.resize_playback()
+            channel.compile_badwords()
+
+    def load_lists(self):
+        """
+        Loads the ban list, I:lines and oper blocks into memory
+        They are reloaded when the files change
+        """
+        interval = self.CONFIG["LIST_RELOAD_INTERVAL"]
+        self.banlist = IPListFile(self.CONFIG["BANLIST"], interval)
+        self.ilines = ILineFile(self.CONFIG["I:LINES"], interval)
+        self.oper_blocks = ListFile("opers.txt", interval)
 
     def load_config(p="./config.json"):
         """
@@ -52,61 +128,82 @@ class Server:
         config = json.load(open("./config.json", 'r'))
         charset = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
         return {
+            "ACCOUNT_CACHE_SIZE": int(config.get("ACCOUNT_CACHE_SIZE", 1000)),
+            "ACCOUNT_FLUSH_INTERVAL": config.get("ACCOUNT_FLUSH_INTERVAL", 1),
             "ADDRESS": config.get("ADDRESS", "127.0.0.1"),
             "BANLIST": config.get("BANLIST", "banlist.txt"),
+            "CHAN_BADWORD_IGNORE_CASE": config.get("CHAN_BADWORD_IGNORE_CASE", False),
             "CHAN_BADWORD_LIMIT": int(config.get("CHAN_BADWORD_LIMIT", 50)),
+            "CHAN_BADWORD_WHOLE_WORDS": config.get("CHAN_BADWORD_WHOLE_WORDS", False),
             "CHAN_BAN_LIMIT": int(config.get("CHANNEL_BAN_LIMIT", 50)),
+            "CHAN_HISTORY": config.get("CHAN_HISTORY", False),
+            "CHAN_HISTORY_PATH": config.get("CHAN_HISTORY_PATH", "history/"),
+            "CHAN_PLAYBACK_LIMIT": int(config.get("CHAN_PLAYBACK_LIMIT", 100)),
             "CHAN_TOPIC_LIMIT": int(config.get("CHAN_TOPIC_LIMIT", 300)),
             "CHANNEL_CREATION": config.get("CHANNEL_CREATION", False),
+            "CONNECT_RATE_IP": config.get("CONNECT_RATE_IP", [5, 10]),
+            "CONNECT_RATE_TOTAL": config.get("CONNECT_RATE_TOTAL", [100, 1]),
             "CONNECTION_LIMIT": int(config.get("CONNECTION_LIMIT", 5)),
             "DEFAULT_CHAN_FLAGS": list(config.get("DEFAULT_CHAN_FLAGS", "n")),
             "DEFAULT_CLIENT_FLAGS": list(config.get("DEFAULT_CLIENT_FLAGS", "i")),
             "DEFUALT_OPER_FLAGS": list(config.get("DEFAULT_OPER_FLAGS", "kw")),
+            "ENGINE": config.get("ENGINE", "thread"),
             "I:LINES": config.get("I:LINES", "ilines.txt"),
+            "LISTEN_BACKLOG": int(config.get("LISTEN_BACKLOG", socket.SOMAXCONN)),
+            "LIST_RELOAD_INTERVAL": config.get("LIST_RELOAD_INTERVAL", 5),
             "MAX_CHAN_NAME_LENGTH": int(config.get("MAX_CHAN_NAME_LENGTH", 20)),
+            "MAX_LINE_LENGTH": int(config.get("MAX_LINE_LENGTH", 2048)),
             "MAX_NICK_LENGTH": int(config.get("MAX_NICK_LENGTH", 12)),
             "MAX_RECV_SIZE": int(config.get("MAX_RECV_SIZE", 2048)),
+            "MAX_SEND_QUEUE": int(config.get("MAX_SEND_QUEUE", 262144)),
+            "METRICS_ADDRESS": config.get("METRICS_ADDRESS", "127.0.0.1"),
+            "METRICS_PORT": int(config.get("METRICS_PORT") or 0),
             "MIN_NICK_LENGTH": int(config.get("MIN_NICK_LENGTH", 1)),
             "NICK_CHAR_SET": config.get("NICK_CHAR_SET", charset),
             "OPER_VHOST": config.get("OPER_VHOST", "server/admin"),
             "PORT": int(config.get("PORT", 5050)),
+            "PROFILE_PATH": config.get("PROFILE_PATH", "profiles/"),
+            "PROFILE_RATE": config.get("PROFILE_RATE", 100),
+            "RATE_LIMITS": dict({
+                "channel": [500, 1000],
+                "channel_total": [5000, 10000],
+                "join": [0.5, 5],
+                "message": [2, 10],
+                "nick": [0.2, 3],
+                "whois": [1, 5],
+            }, **config.get("RATE_LIMITS", {})),
             "RESERVED_NICKS": config.get("RESERVED_NICKS", []),
             "SERVER_ADMIN_CHANNEL": config.get("SERVER_ADMIN_CHANNEL", "&ADMIN"),
             "SERVER_MAX_USERS": int(config.get("SERVER_MAX_USERS", 100)),
+            "STORAGE": config.get("STORAGE", "json"),
+            "STORAGE_PATH": config.get("STORAGE_PATH", "awwrc.db"),
             "TIMEOUT": config.get("TIMEOUT", 0.5),
         }
 
     def load_channels(self):
         """
-        Looks in the channel folder for channel json files
+        Loads the saved channels from storage
         and creates channels based of that information
         """
         channels = {}
-        for c in glob.glob("channels/*.json"):
+        for name, channel in self.storage.channels():
             try:
-                channel = json.load(open(c, 'r'))
                 channels[channel["name"]] = Channel(self,
                     channel.get("name", "Unknown"), channel.get("flags", {}),
                     channel.get("topic", ""), channel.get("banlist", []),
                     channel.get("ops", []), channel.get("owner", ""),
                     channel.get("badwords", []), channel.get("public_notes", ""),
                     channel.get("op_notes", ""))
-                print("Loaded channel %s from %s" % (channel["name"], c))
+                print("Loaded channel %s" % channel["name"])
             except:
-                print("Failed to load channel json %s" % c)
+                print("Failed to load channel %s" % name)
         return channels
 
     def get_account(self, nick):
         """
         Returns the account of `nick`
         """
-        if os.path.exists("accounts/%s.json" % nick):
-            return json.load(open("accounts/%s.json" % nick))
-
-    def get_ilines(self):
-        with open(self.CONFIG["I:LINES"], 'r') as f:
-            for line in f.readlines():
-                yield line.split()[0]
+        return self.accounts.get(nick)
 
     def change_account_passwd(self, client, hashedpw):
         """
@@ -114,68 +211,100 @@ class Server:
         """
         account = self.get_account(client.nick)
         if account:
-            account["password"] = hashedpw
-            with open("accounts/%s.json" % client.nick, 'w') as f:
-                f.write(json.dumps(account))
+            with self.accounts.lock:
+                account["password"] = hashedpw
+                self.accounts.save(client.nick, account)
             client.writeline(json.dumps({
                 "type": "SERVERMSG",
                 "message": "You have succesfully changed your account password"
             }))
 
-    def register_client(self, client):
+    def check_connection(self, ip):
+        """
+        Decides if a new connection from `ip` is let on the server
+        Runs before a Client is made for it
+        Returns the data to send before closing it or None if it's let on
+        """
         # if the server is full tell the client and disconnect them
         if len(self.clients) >= self.CONFIG["SERVER_MAX_USERS"]:
-            client.writeline(json.dumps({
-                "type": "SERVERFULL"
-            }))
-            client.quit()
-            return False
+            return SERVER_FULL
+        # if this client is banned tell them to GTFO and disconnect them
+        if ip in self.banlist:
+            self.writeline("%s is banned." % ip)
+            return SERVER_BANNED
         # if too many connections from this IP disconnect client
         # if the client doesn't have an I:Line
-        if not client.ip in self.get_ilines():
-            # See if IP breaks connection limit
-            if (self.ips.count(client.ip) + 1) > self.CONFIG["CONNECTION_LIMIT"]:
-                client.writeline(json.dumps({
-                    "type": "SERVERMSG",
-                    "message": "Too many connections from this IP"
+        if ip not in self.ilines:
+            if self.ips[ip] >= self.CONFIG["CONNECTION_LIMIT"]:
+                return TOO_MANY_CONNECTIONS
+            if not self.connects.allow_ip(ip, self.CONFIG["CONNECT_RATE_IP"]):
+                return CONNECTING_TOO_FAST
+        if not self.connects.allow_total(self.CONFIG["CONNECT_RATE_TOTAL"]):
+            return CONNECTING_TOO_FAST
+
+    def register_client(self, client):
+        """
+        Lets a client on the server, sends them the greeting and asks
+        for a nick. check_connection already decided they can connect
+        """
+        self.add_client(client)
+        self.writeline("%s is registered as %s" % (client.ip, client.nick))
+        # One write, only the user count changes between clients
+        client.send_raw(self.greeting + json.dumps({
+            "type": "SERVERUSERS",
+            "amount": len(self.clients)
+        }) + '\n' + PICK_NICK)
+        return True
+
+    def take_buffer(self):
+        """
+        Returns a receive buffer and a memoryview of it for Client.fill
+        Reuses a spare one so busy clients don't allocate on every read
+        """
+        size = max(self.CONFIG["MAX_RECV_SIZE"], self.CONFIG["MAX_LINE_LENGTH"] + 1)
+        try:
+            buf, view = self.recv_buffers.pop()
+            if len(buf) == size: # else the config changed, make a new one
+                return buf, view
+        except IndexError:
+            pass
+        buf = bytearray(size)
+        return buf, memoryview(buf)
+
+    def give_buffer(self, buf, view):
+        """
+        Takes back a receive buffer a client has no data in
+        """
+        if len(self.recv_buffers) < RECV_BUFFER_POOL:
+            self.recv_buffers.append((buf, view))
+
+    def build_greeting(self):
+        """
+        Encodes the MOTD and SERVERCONFIG sent to every new client
+        Runs on start, rehash and set_motd
+        """
+        lines = [json.dumps({"type": "SERVERMOTDSTART"})]
+        if os.path.exists("motd.txt"):
+            for line in open("motd.txt", 'r').readlines():
+                lines.append(json.dumps({
+                    "type": "SERVERMOTD",
+                    "message": r"%s" % line.strip("\n")
                 }))
-                client.quit()
-                return False
-        # if this client is banned tell them to GTFO and disconnect them
-        if client.ip in [ip.strip() for ip in open(self.CONFIG["BANLIST"], 'r').readlines()]:
-            self.writeline("%s is banned." % (client.ip))
-            client.writeline(
-                json.dumps({"type": "YOUSERVERBANNED"}))
-            client.quit()
-            return False
-        else: # let the clinet on the server
-            self.users[client.nick] = client
-            self.ips.append(client.ip)
-            self.writeline("%s is registered as %s" % (client.ip, client.nick))
-            client.writeline(json.dumps({
-                "type": "SERVERMOTDSTART"
-            }))
-            if os.path.exists("motd.txt"):
-                for line in open("motd.txt", 'r').readlines():
-                    client.writeline(json.dumps({
-                        "type": "SERVERMOTD",
-                        "message": r"%s" % line.strip("\n")
-                    }))
-            client.writeline(json.dumps({
-                "type": "SERVERMOTDEND"
-            }))
-            client.writeline(json.dumps({
-                "type": "SERVERCONFIG",
-                "config": self.CONFIG
-            }))
-            client.writeline(json.dumps({
-                "type": "SERVERUSERS",
-                "amount": len(self.clients)
-            }))
-            return True
+        lines.append(json.dumps({"type": "SERVERMOTDEND"}))
+        lines.append(json.dumps({
+            "type": "SERVERCONFIG",
+            "config": dict((key, self.CONFIG[key]) for key in PUBLIC_CONFIG)
+        }))
+        self.greeting = '\n'.join(lines) + '\n'
 
     def register_account(self, client, email, hashedpw):
-        if os.path.exists("accounts/%s.json" % client.nick):
+        if not self.accounts.create(client.nick, {
+                "email": email,
+                "password": hashedpw,
+                "notes": [],
+                "uuid": client.nick + ':' + str(uuid.uuid4()),
+                "time_registered": int(time.time())
+            }):
             client.writeline("This nick is already registered.")
             client.writeline(json.dumps({
                 "type": "ERROR",
@@ -183,14 +312,6 @@ class Server:
                 "message": "Nick is already registered"
             }))
         else:
-            with open("accounts/%s.json" % client.nick, 'w') as f:
-                f.write(json.dumps({
-                    "email": email,
-                    "password": hashedpw,
-                    "notes": [],
-                    "uuid": client.nick + ':' + str(uuid.uuid4()),
-                    "time_registered": int(time.time())
-                }, sort_keys=True, indent=4, separators=(',', ': ')))
             self.writeline(
                 "%s created a new account [%s]" % (client.ip, client.nick))
             client.writeline(json.dumps({
@@ -200,15 +321,82 @@ class Server:
 
     def find_nick(self, nick):
         """
-        Finds `nick` on the server
+        Finds `nick` on the server, ignoring case
+        Returns the nick as the client uses it
+        """
+        return self.nicks.get(nick.lower())
+
+    def add_client(self, client):
+        """
+        Runs when a client is let on the server
+        """
+        with self.lock:
+            self.clients.add(client)
+            self.ips[client.real_ip] += 1
+            self.add_user(client)
+
+    def remove_client(self, client):
+        """
+        Runs when a client quits or is killed
+        Safe to call more than once
+        """
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                self.traffic = map(sum, zip(self.traffic, metrics.traffic(client)))
+                self.ips[client.real_ip] -= 1
+                if not self.ips[client.real_ip]:
+                    del self.ips[client.real_ip]
+            self.remove_user(client)
+            if client in self.opers:
+                self.opers.remove(client)
+
+    def count_disconnect(self, reason):
+        """
+        Counts why a client left, see Client.quit
+        """
+        with self.lock:
+            self.disconnects[reason] += 1
+
+    def add_user(self, client):
+        """
+        Adds a client to the user and nick indexes
+        """
+        with self.lock:
+            self.users[client.nick] = client
+            self.nicks[client.nick.lower()] = client.nick
+
+    def rename_user(self, client, new_nick):
+        """
+        Changes a clients nick and keeps the indexes in sync
+        The nick is checked and taken under the lock, so two clients
+        can't both get it. Changing only the case is allowed
+        Returns False if another client has the nick
+        """
+        with self.lock:
+            taken = self.find_nick(new_nick)
+            if taken and self.users.get(taken) is not client:
+                return False
+            old_nick = client.nick
+            self.remove_user(client)
+            client.nick = intern(str(new_nick)) # one copy shared by every index
+            self.add_user(client)
+        for channel in client.channels.values():
+            channel.on_nick(client, old_nick)
+        return True
+
+    def remove_user(self, client):
+        """
+        Removes a client from the user and nick indexes
         """
-        for n in [(nk, nk.lower()) for nk in self.users.keys()]:
-            if n[1] == nick.lower():
-                return n[0]
+        with self.lock:
+            if self.users.get(client.nick) is client:
+                del self.users[client.nick]
+                self.nicks.pop(client.nick.lower(), None)
 
     def client_login(self, client, hashedpw):
-        if os.path.exists("accounts/%s.json" % client.nick):
-            user = json.load(open("accounts/%s.json" % client.nick, 'r'))
+        user = self.accounts.get(client.nick)
+        if user:
             if hashedpw == user["password"]:
                 client.account = user
                 client.writeline(json.dumps({
@@ -237,9 +425,7 @@ class Server:
         Turns the client into an oper (Server Operator)
         """
         self.writeline("%s used the oper command" % client.ip)
-        oper_blocks = [op.strip()
-                       for op in open("./opers.txt", "r").readlines()]
-        if client.ip + '|' + hashedpw in oper_blocks:
+        if client.ip + '|' + hashedpw in self.oper_blocks:
             if self.CONFIG["OPER_VHOST"]:
                 client.ip = self.CONFIG["OPER_VHOST"]
             client.add_flag('O')
@@ -262,23 +448,27 @@ class Server:
         """
         Sends a message to all opers with `w` flag
         """
+        data = json.dumps({
+            "type": "OPERMSG",
+            "nick": client.nick,
+            "message": message
+        }) + '\n'
         for oper in self.opers:
             if 'w' in oper.flags:
-                oper.writeline(json.dumps({
-                    "type": "OPERMSG",
-                    "nick": client.nick,
-                    "message": message
-                }))
+                oper.send_raw(data)
 
     def global_message(self, message):
         """
         Send a message to all clients connected to the server
         """
-        for client in self.clients:
-            client.writeline(json.dumps({
-                "type": "SERVERMSG",
-                "message": "ANNOUNCEMENT: " + message
-            }))
+        data = json.dumps({
+            "type": "SERVERMSG",
+            "message": "ANNOUNCEMENT: " + message
+        }) + '\n'
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.send_raw(data)
 
     def client_whois(self, client, nick):
         if self.users.get(nick):
@@ -315,9 +505,169 @@ class Server:
         """
         Ban a ip from joining the server
         """
-        with open("banlist.txt", 'a') as f:
-            f.write(ip + "\n")
-        self.writeline("Added %s to banlist.txt" % ip)
+        self.banlist.add(ip)
+        self.writeline("Added %s to %s" % (ip, self.CONFIG["BANLIST"]))
+
+    def get_stats(self):
+        """
+        Returns live stats about the server
+        Cheap enough to be polled every second
+        """
+        with self.lock:
+            clients = list(self.clients)
+            totals = list(self.traffic)
+        queues = []
+        for client in clients:
+            totals = map(sum, zip(totals, metrics.traffic(client)))
+            queues.append(client.outbox_size)
+        counters = dict(zip(metrics.TRAFFIC, totals))
+        counters["accepted"] = self.accepted
+        counters["rejected"] = self.rejected
+        with self.lock:
+            rates = self.rates.update(counters)
+        return {
+            "uptime": time.time() - self.started,
+            "engine": self.CONFIG["ENGINE"],
+            "clients": len(clients),
+            "opers": len(self.opers),
+            "threads": threading.active_count(),
+            "channels": dict((name, len(channel.clients))
+                             for name, channel in self.channels.items()),
+            "totals": counters,
+            "rates": rates,
+            "send_queue": {
+                "bytes": sum(queues),
+                "max": max(queues) if queues else 0,
+                "waiting": len([size for size in queues if size])
+            },
+            "rss": metrics.rss()
+        }
+
+    def get_memory(self):
+        """
+        Counts what the server keeps per client and channel
+        Sizes are approximate, see memory.size_of
+        """
+        with self.lock:
+            clients = list(self.clients)
+            users = len(self.users)
+            nicks = len(self.nicks)
+            ips = len(self.ips)
+        channels = self.channels.values()
+        histories = [channel.history for channel in channels if channel.history]
+        queues = [client.outbox_size for client in clients if client.outbox]
+        return {
+            "clients": {
+                "count": len(clients),
+                "bytes": sum(memory.size_of(client) for client in clients),
+                "receive_buffers": sum(len(client.inbuf) for client in clients
+                                       if client.inbuf is not None),
+                "spare_buffers": sum(len(buf) for buf, view in list(self.recv_buffers))
+            },
+            "send_queues": {
+                "count": len(queues),
+                "lines": sum(len(client.outbox) for client in clients),
+                "bytes": sum(queues)
+            },
+            "channels": {
+                "count": len(channels),
+                "members": sum(len(channel.clients) for channel in channels),
+                "bytes": sum(memory.size_of(channel) for channel in channels),
+                "user_flags": sum(len(channel.user_flags) for channel in channels),
+                "bans": sum(len(channel.banlist) for channel in channels)
+            },
+            "playback": {
+                "lines": sum(len(channel.messages) for channel in channels),
+                "bytes": sum(len(line) for channel in channels
+                             for line in list(channel.messages))
+            },
+            "history": {
+                "open": len(histories),
+                "lines": sum(history.count for history in histories),
+                "bytes": sum(history.size for history in histories),
+                "mapped": sum(len(history.map) for history in histories
+                              if history.map is not None)
+            },
+            "server": {
+                "users": users,
+                "nicks": nicks,
+                "ips": ips,
+                "connect_windows": len(self.connects.by_ip),
+                "accounts_cached": len(self.accounts),
+                "accounts_dirty": len(self.accounts.dirty),
+                "profile_stacks": len(self.profiler.stacks)
+            }
+        }
+
+    def get_metrics(self):
+        """
+        Returns the server metrics in the Prometheus text format
+        """
+        stats = self.get_stats()
+        out = metrics.Exposition()
+        out.add("awwrc_uptime_seconds", "gauge",
+            "Seconds since the server started", stats["uptime"])
+        out.add("awwrc_clients", "gauge",
+            "Clients connected", stats["clients"])
+        out.add("awwrc_opers", "gauge",
+            "Opers connected", stats["opers"])
+        out.add("awwrc_threads", "gauge",
+            "Threads running", stats["threads"])
+        out.add("awwrc_resident_memory_bytes", "gauge",
+            "Resident memory of the server", stats["rss"])
+        out.add("awwrc_send_queue_bytes", "gauge",
+            "Bytes waiting to be sent to clients", stats["send_queue"]["bytes"])
+        out.add("awwrc_send_queue_max_bytes", "gauge",
+            "Bytes waiting for the furthest behind client", stats["send_queue"]["max"])
+        out.add("awwrc_send_queue_waiting", "gauge",
+            "Clients with data waiting to be sent", stats["send_queue"]["waiting"])
+        out.add("awwrc_connections_accepted_total", "counter",
+            "Connections accepted", stats["totals"]["accepted"])
+        out.add("awwrc_connections_rejected_total", "counter",
+            "Connections rejected by the connection checks", stats["totals"]["rejected"])
+        for name in metrics.TRAFFIC:
+            kind, direction = name.split("_")
+            out.add("awwrc_%s_%s_total" % (kind, direction), "counter",
+                "%s %s clients" % (kind.capitalize(),
+                    "received from" if direction == "in" else "sent to"),
+                stats["totals"][name])
+        with self.lock:
+            disconnects = sorted(self.disconnects.items())
+        out.add("awwrc_disconnects_total", "counter",
+            "Clients that left, by reason",
+            [({"reason": reason}, count) for reason, count in disconnects])
+        channels = sorted(self.channels.items())
+        out.add("awwrc_channel_members", "gauge", "Clients in a channel",
+            [({"channel": name}, len(channel.clients)) for name, channel in channels])
+        out.add("awwrc_channel_broadcasts_total", "counter",
+            "Lines sent to everyone in a channel",
+            [({"channel": name}, channel.broadcasts) for name, channel in channels])
+        out.histogram("awwrc_fanout_seconds",
+            "Time taken to send a line to everyone in a channel",
+            [({}, self.fanout)])
+        used = [command for command in COMMANDS if command.stats.calls]
+        out.add("awwrc_command_calls_total", "counter", "Commands run",
+            [({"command": command.name}, command.stats.calls) for command in used])
+        out.histogram("awwrc_command_seconds", "Time taken to run a command",
+            [({"command": command.name}, command.stats) for command in used])
+        out.add("awwrc_storage_operations_total", "counter",
+            "Accounts and channels read from and written to storage",
+            [({"kind": kind, "op": op}, count)
+             for (kind, op), count in sorted(self.storage.io.items())])
+        return out.text()
+
+    def start_metrics(self):
+        """
+        Starts the metrics listener if METRICS_PORT is set
+        """
+        address = (self.CONFIG["METRICS_ADDRESS"], self.CONFIG["METRICS_PORT"])
+        try:
+            self.metrics = metrics.MetricsServer(address, self.get_metrics)
+        except socket.error, err:
+            print("Metrics listener error: %s" % err)
+            return
+        self.metrics.start()
+        print("Metrics on http://%s:%s/metrics" % address)
 
     def set_motd(self, motd):
         """
@@ -325,6 +675,7 @@ class Server:
         """
         with open("motd.txt", 'w') as f:
             f.write(motd)
+        self.build_greeting()
 
     def writeline(self, message):
         print(message)
@@ -352,6 +703,47 @@ class Server:
             "channels": chans
         }))
 
+    def on_accept(self, client_sock):
+        """
+        Creates a Client for a newly accepted socket and hands it
+        to the thread or event engine
+        """
+        try:
+            client = Client(client_sock, self)
+            if self.loop:
+                self.loop.register(client)
+            if self.register_client(client) and not self.loop:
+                client.start()
+        except Exception, err:
+            print("Client error: %s" % err)
+
+    def accept_clients(self):
+        """
+        Accepts every connection waiting in the listen backlog
+        so a burst of connections is handled in one wakeup
+        """
+        while True:
+            try:
+                client_sock, address = self.sock.accept()
+            except socket.error, err:
+                if err.errno in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print("Accept error: %s" % err)
+                return
+            self.accepted += 1
+            reject = self.check_connection(address[0])
+            if reject:
+                self.rejected += 1
+                try: # best effort, never wait on a rejected socket
+                    client_sock.send(reject, socket.MSG_DONTWAIT)
+                except socket.error:
+                    pass
+                client_sock.close()
+                continue
+            client_sock.setblocking(1)
+            self.on_accept(client_sock)
+
     def run(self):
         '''
         Server main loop.
@@ -369,11 +761,15 @@ class Server:
                 sys.exit(1)
             try:  # Create the socket
                 self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                # Allow rebinding right after a restart
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 # Bind it to the interface and port we want to listen on
                 self.sock.bind((self.CONFIG["ADDRESS"], self.CONFIG["PORT"]))
-                # Listen for incoming connections. This server can handle up to
-                # 5 simultaneous connections
-                self.sock.listen(50)
+                # Listen for incoming connections. Up to LISTEN_BACKLOG
+                # connections can wait to be accepted
+                self.sock.listen(self.CONFIG["LISTEN_BACKLOG"])
+                # accept() never blocks, see accept_clients
+                self.sock.setblocking(0)
                 all_good = True
                 break
             except socket.error, err:
@@ -385,34 +781,29 @@ class Server:
 
         print ("`telnet %s %s`" %
                (self.CONFIG["ADDRESS"], self.CONFIG["PORT"]))
+        if self.CONFIG["METRICS_PORT"]:
+            self.start_metrics()
 
         try:
+            if self.CONFIG["ENGINE"] == "event":
+                # One event loop handles every connection
+                self.loop = EventLoop(self)
+                self.writer = self.loop
+                self.loop.run()
+            # Client threads only read, queued writes are sent by the writer
+            self.writer = OutboundWriter(self)
+            self.writer.start()
             while True:
+                # Wait until at least one connection is ready to be accepted
                 try:
-                    self.sock.settimeout(0.5)  # .5 second timeout
-                    client_sock = self.sock.accept()[0]
-                except socket.timeout:
-                    # No connection detected, sleep for one second, then check
-                    time.sleep(1)
-                    continue
-                # Create the Client object and let it handle the incoming
-                # connection
-                try:
-                    client = Client(client_sock, self)
-                    if self.register_client(client):
-                        self.clients.append(client)
-                        client.start()
-                    # Go over the list of threads, remove those that have finished
-                    # (their run method has finished running) and wait for them
-                    # to fully finish
-                    self.users = {}
-                    for client in self.clients:
-                        if not client.isAlive():
-                            self.clients.remove(client)
-                        else:
-                            self.users[client.nick] = client
-                except Exception, err:
-                    print("Client error: %s" % err)
+                    select.select([self.sock], [], [])
+                except select.error, err:
+                    if err[0] == errno.EINTR:
+                        continue
+                    raise
+                # Create a Client for every waiting connection and let it
+                # handle the incoming connection
+                self.accept_clients()
 
         except KeyboardInterrupt:
             print 'Ctrl+C pressed... Shutting Down'
@@ -427,6 +818,7 @@ class Server:
         #    did finish in the requested time
         #
         for client in self.clients:
-            client.join(1.0)
+            if client.thread:
+                client.thread.join(1.0)
         # Close the socket once we're done with it
         self.sock.close()
@@ -0,0 +1,224 @@
+import os
+import json
+import glob
+import sqlite3
+import tempfile
+import threading
+
+from collections import Counter
+
+def encode(data):
+    return json.dumps(data, sort_keys=True, indent=4, separators=(',', ': '))
+
+
+class JSONBackend:
+    """
+    Stores every account and channel in its own json file
+    accounts/<nick>.json and channels/<name>.json
+    """
+    def __init__(self, accounts="accounts/", channels="channels/"):
+        self.accounts_path = accounts
+        self.channels_path = channels
+        self.lock = threading.Lock()
+        self.io = Counter() # (accounts|channels, read|write) -> files
+        for path in (accounts, channels):
+            if not os.path.exists(path):
+                os.mkdir(path, 0777)
+
+    def read(self, path):
+        try:
+            with open(path, 'r') as f:
+                return json.load(f)
+        except IOError: # no such file
+            return None
+
+    def write(self, path, data):
+        """
+        Replaces a file with a rename so a crash never leaves half
+        a file behind. Every write has its own temp file, client threads
+        can save the same channel at once
+        """
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path) or ".")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(encode(data))
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp, 0644) # mkstemp makes it 0600
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def count(self, kind, op, amount=1):
+        with self.lock:
+            self.io[kind, op] += amount
+
+    def account_file(self, nick):
+        return os.path.join(self.accounts_path, "%s.json" % nick)
+
+    def channel_file(self, name):
+        return os.path.join(self.channels_path, "%s.json" % name)
+
+    def get_account(self, nick):
+        """
+        Returns the account of `nick` or None
+        """
+        if not nick or '/' in nick or nick.startswith('.'):
+            return None
+        self.count("accounts", "read")
+        return self.read(self.account_file(nick))
+
+    def get_account_by_uuid(self, uuid):
+        """
+        Returns (nick, account) for an account uuid or None
+        There is no index, every account file is read
+        """
+        for nick, account in self.accounts():
+            if account.get("uuid") == uuid:
+                return nick, account
+
+    def put_accounts(self, accounts):
+        """
+        Saves a list of (nick, account)
+        """
+        for nick, account in accounts:
+            self.write(self.account_file(nick), account)
+            self.count("accounts", "write")
+
+    def accounts(self):
+        """
+        Yields (nick, account) for every account
+        """
+        for path in glob.glob(self.account_file('*')):
+            account = self.read(path)
+            self.count("accounts", "read")
+            if account is not None:
+                yield os.path.basename(path)[:-len(".json")], account
+
+    def put_channels(self, channels):
+        """
+        Saves a list of (name, channel)
+        """
+        for name, channel in channels:
+            self.write(self.channel_file(name), channel)
+            self.count("channels", "write")
+
+    def channels(self):
+        """
+        Yields (name, channel) for every channel
+        """
+        for path in glob.glob(self.channel_file('*')):
+            self.count("channels", "read")
+            try:
+                channel = self.read(path)
+            except ValueError:
+                print("Failed to load channel json %s" % path)
+                continue
+            if channel is not None:
+                yield channel.get("name", "Unknown"), channel
+
+    def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """
+    Stores accounts and channels in one sqlite database
+    Accounts are indexed by nick and uuid, channels by name
+    """
+    def __init__(self, path="awwrc.db"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.io = Counter() # (accounts|channels, read|write) -> rows
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # WAL lets readers go on while a batch is written
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS accounts ("
+            "nick TEXT PRIMARY KEY, uuid TEXT, data TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS accounts_uuid "
+            "ON accounts (uuid)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS channels ("
+            "name TEXT PRIMARY KEY, data TEXT NOT NULL)")
+        self.db.commit()
+
+    def get_account(self, nick):
+        """
+        Returns the account of `nick` or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data FROM accounts WHERE nick = ?",
+                (nick,)).fetchone()
+            self.io["accounts", "read"] += 1
+        if row:
+            return json.loads(row[0])
+
+    def get_account_by_uuid(self, uuid):
+        """
+        Returns (nick, account) for an account uuid or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT nick, data FROM accounts WHERE uuid = ?",
+                (uuid,)).fetchone()
+            self.io["accounts", "read"] += 1
+        if row:
+            return row[0], json.loads(row[1])
+
+    def put_accounts(self, accounts):
+        """
+        Saves a list of (nick, account) in one transaction
+        """
+        rows = [(nick, account.get("uuid"), json.dumps(account))
+            for nick, account in accounts]
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO accounts "
+                    "(nick, uuid, data) VALUES (?, ?, ?)", rows)
+            self.io["accounts", "write"] += len(rows)
+
+    def accounts(self):
+        """
+        Yields (nick, account) for every account
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT nick, data FROM accounts").fetchall()
+            self.io["accounts", "read"] += len(rows)
+        for nick, data in rows:
+            yield nick, json.loads(data)
+
+    def put_channels(self, channels):
+        """
+        Saves a list of (name, channel) in one transaction
+        """
+        rows = [(name, json.dumps(channel)) for name, channel in channels]
+        with self.lock:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO channels "
+                    "(name, data) VALUES (?, ?)", rows)
+            self.io["channels", "write"] += len(rows)
+
+    def channels(self):
+        """
+        Yields (name, channel) for every channel
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT name, data FROM channels").fetchall()
+            self.io["channels", "read"] += len(rows)
+        for name, data in rows:
+            yield name, json.loads(data)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_backend(kind="json", path="awwrc.db", root=""):
+    """
+    Opens the storage backend named in the config
+    `root` is prepended to relative paths (scripts run from scripts/)
+    """
+    if kind == "sqlite":
+        return SQLiteBackend(os.path.join(root, path))
+    return JSONBackend(os.path.join(root, "accounts/"),
+                       os.path.join(root, "channels/"))
@@ -0,0 +1,108 @@
+from collections import deque
+
+
+def to_unicode(text):
+    if isinstance(text, str):
+        return text.decode("utf-8", "replace")
+    return text
+
+
+class WordFilter:
+    """
+    Finds every word of a word list in a message with one pass over it
+    The words are compiled into an Aho-Corasick automaton so the cost
+    of a check doesn't grow with the amount of words
+    ignore_case: match words no matter the case
+    whole_words: only match words that aren't part of a longer word
+    """
+    def __init__(self, words=(), ignore_case=False, whole_words=False):
+        self.ignore_case = ignore_case
+        self.whole_words = whole_words
+        self.goto = [{}] # state -> {char: next state}
+        self.fail = [0]
+        self.out = [[]] # state -> (word, length) of words ending here
+        self.words = set()
+        for word in words:
+            self.add(word)
+        self.compile()
+
+    def fold(self, text):
+        text = to_unicode(text)
+        if self.ignore_case:
+            return text.lower()
+        return text
+
+    def add(self, word):
+        """
+        Adds a word to the trie, compile() has to run afterwards
+        """
+        key = self.fold(word)
+        if not key or key in self.words:
+            return
+        self.words.add(key)
+        state = 0
+        for char in key:
+            if char not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+                self.goto[state][char] = len(self.goto) - 1
+            state = self.goto[state][char]
+        self.out[state].append((word, len(key)))
+
+    def compile(self):
+        """
+        Builds the failure links, breadth first from the root
+        """
+        queue = deque(self.goto[0].values())
+        for state in queue:
+            self.fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def is_boundary(self, text, start, end):
+        """
+        Checks that text[start:end] isn't part of a longer word
+        """
+        if start > 0 and text[start - 1].isalnum():
+            return False
+        if end < len(text) and text[end].isalnum():
+            return False
+        return True
+
+    def find(self, text):
+        """
+        Returns the words found in `text` in the order they show up
+        Each word is only returned once
+        """
+        if not self.words:
+            return []
+        text = self.fold(text)
+        found = []
+        state = 0
+        goto, fail, out = self.goto, self.fail, self.out
+        for i, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for word, length in out[state]:
+                if word in found:
+                    continue
+                if self.whole_words and not self.is_boundary(
+                        text, i + 1 - length, i + 1):
+                    continue
+                found.append(word)
+        return found
+
+    def __contains__(self, word):
+        return self.fold(word) in self.words
+
+    def __len__(self):
+        return len(self.words)